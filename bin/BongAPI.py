@@ -1,15 +1,17 @@
-import os
-import os.path
-import sys
-import sqlite3
 import time
-import codecs
-import urllib
-import urllib2
 import logging
 import xml.etree.cElementTree as ET
 import BongEnvironment
-from BongLibrary import unicode_string, bongDateTimeToSqlite, bongTimeToSqlite, unescape
+import BongHttp
+import BongDatabase
+import BongCache
+import BongMetrics
+import BongLogging
+import BongLease
+import BongDuplicates
+import BongIndex
+from BongLogging import LazyMessage
+from BongLibrary import unicode_string, unescape, normalizeRecordings, RECORDING_FIELDS, TeeReader
 
 class BongApi:
     """description of class"""
@@ -26,11 +28,18 @@ class BongApi:
             return unescape(node.text)
 
 
-    def __init__(self):
+    def __init__(self, account=None):
+        """
+        account is one of the accounts in BongEnvironment.settings['accounts'],
+        by default the account of the [bong.tv] section
+        """
+        if account is None:
+            account = BongEnvironment.settings['accounts'][0]
         self.recordings = {}
-        self.username = BongEnvironment.settings['bong_username']
-        self.password = BongEnvironment.settings['bong_password']
-        self.server = BongEnvironment.settings['bong_server']
+        self.account = account['name']
+        self.username = account['username']
+        self.password = account['password']
+        self.server = account['server']
         self.reccat = ( "id"
                       , "title"
                       , "subtitle"
@@ -45,19 +54,61 @@ class BongApi:
                       , "series_number"
                       , "series_count"
                       , "downloadHQ")
-        self.cacheLifeSpan = 30 
+        self.cache = BongCache.ResponseCache( BongEnvironment.settings['cachedir']
+                                            , BongEnvironment.settings['cacheLifeSpans']
+                                            , BongEnvironment.settings['cacheLifeSpan']
+                                            , BongEnvironment.settings['cacheMaxBytes'])
+        # validators of the last recordings list for conditional requests
+        self.etag = None
+        self.lastModified = None
+        self.listChanged = True
+        # ids of the last complete list of recordings, None if unknown
+        self.listIds = None
+        # the last list of recordings was taken from the cache
+        self.listCached = False
+        # ids of recordings the last refresh could not store
+        self.conflicts = set()
+        # long-running processes rely on conditional requests instead of the cache
+        self.conditionalRequests = False
+        self.http = BongHttp.ConnectionPool( self.server
+                                           , size = BongEnvironment.settings['connectionPoolSize']
+                                           , idleTimeout = BongEnvironment.settings['connectionIdleTimeout'])
+
+    def _apiRequest(self, path, headers=None):
+        """
+        send a request for the given API path on a pooled keep-alive connection
+        """
+        if path.endswith('/delete.xml'):
+            endpoint = 'delete'
+        else:
+            endpoint = path.rsplit('/', 1)[-1].replace('.xml', '')
+        with BongMetrics.apiRequestSeconds.time(endpoint=endpoint):
+            return self.http.request(path, self._credentials(), headers)
+
+    def resetValidators(self):
+        """
+        forget the validators of the last recordings list, so the next
+        call of getRecordings() fetches and parses the complete list
+        """
+        self.etag = None
+        self.lastModified = None
 
     def getSetOfIds(self):
         return set(self.recordings.keys())
         
     
     def dumpRecordings(self, bong_id=""):
+        """
+        write the values of one or all recordings to the log at verbosity tier dump
+        """
         if not self.recordings:
             return False
+        if not BongEnvironment.logger.isEnabledFor(BongLogging.DUMP):
+            return False
         
         allattr = set()
         for id, kv in self.recordings.items():
-            allattr.union(set(kv.keys()))
+            allattr.update(kv.keys())
         reqattr = set(self.reccat)
         addattr = allattr - reqattr
         
@@ -65,63 +116,126 @@ class BongApi:
         if addattr:
             addattr = list(addattr)
             addattr.sort()
-            BongEnvironment.logger.info(u"the list of recordings contains additional attributes: {!s}".format(addattr))
+            BongEnvironment.logger.log(BongLogging.DUMP, LazyMessage(u"the list of recordings contains additional attributes: {!s}", addattr))
             orderedkeys.extend(addattr)
 
-        if bong_id != "" and bong_id in self.recordings.keys():
+        if bong_id != "" and bong_id in self.recordings:
             selected = {bong_id: self.recordings[bong_id]}
         else:
             selected = self.recordings.copy()     
         
-        BongEnvironment.logger.info(u"-"*60)
+        BongEnvironment.logger.log(BongLogging.DUMP, u"-"*60)
         
         for id, kv in selected.items():
-            BongEnvironment.logger.info(u"values for recording {!s}".format(id))
+            BongEnvironment.logger.log(BongLogging.DUMP, LazyMessage(u"values for recording {!s}", id))
             for k in orderedkeys:
-                if k in kv.keys():
-                    BongEnvironment.logger.info(u"{} = {!r}".format(k, kv[k]))
-            BongEnvironment.logger.info(u"-"*60)
+                if k in kv:
+                    BongEnvironment.logger.log(BongLogging.DUMP, LazyMessage(u"{} = {!r}", k, kv[k]))
+            BongEnvironment.logger.log(BongLogging.DUMP, u"-"*60)
 
     
-    def useCachedResponse(self, cachefile):
-        lifespan = BongEnvironment.settings['cacheLifeSpan']
-        if 0 < lifespan:
-            fn = BongEnvironment.settings[cachefile]
-            if os.path.isfile(fn):
-                if (time.time() - os.path.getmtime(fn)) < lifespan:
-                    return True
-        return False
-    
-    def getCachedResponse(self, cachefile):
-        fn = BongEnvironment.settings[cachefile]
-        with codecs.open(fn, "r", "utf-8") as f:
-            return f.read() 
-        
-    def cacheResponse(self, cachefile, xmldata):
-        fn = BongEnvironment.settings[cachefile]
-        with codecs.open(fn,'w','utf-8') as f:
-            f.write(xmldata)
-    
-    def killCachedResponse(self, cachefile):
-        fn = BongEnvironment.settings[cachefile]
-        if os.path.isfile(fn):
-            os.remove(fn)
-        
+    def _credentials(self):
+        return { 'username' : self.username
+               , 'password' : self.password }
+
+    def _useRecordings(self, recordings):
+        """
+        fill the list of recordings with copies of the given entries, so that
+        changes made by refreshDatabase() do not alter cached results
+        """
+        for id, kv in recordings.items():
+            self.recordings[id] = dict(kv)
+
+    def _recordingItems(self, rec):
+        """
+        collect the sub-elements of a <recording> element into a dictionary
+        """
+        recitems = {}
+        for item in rec:
+            if item.tag != u"files":
+                recitems[item.tag] = unescape(item.text)
+        for media in rec.findall("files/file"):
+            if self._et_node_text(media, "type") == 'download':
+                if self._et_node_text(media, "quality") == 'HQ':
+                    recitems["downloadHQ"] = self._et_node_text(media, "url")
+                elif self._et_node_text(media, "quality") == 'NQ':
+                    recitems["downloadNQ"] = self._et_node_text(media, "url")
+        return recitems
+
+    def _parseRecordings(self, source):
+        """
+        incrementally parse a recordings.xml document from a file-like source
+
+        Each <recording> is converted as soon as its end tag has been read
+        and then discarded, so the complete tree is never held in memory.
+        Returns the text of the <status> element and a flag telling whether
+        all recordings carried the required elements.
+        """
+        status = "false"
+        root = None
+        depth = 0
+        for event, elem in ET.iterparse(source, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            if elem.tag == "status" and depth == 1:
+                status = unescape(elem.text)
+            elif elem.tag == "recording":
+                id = self._et_node_text(elem, "id", None)
+                if id:
+                    recitems = self._recordingItems(elem)
+                    self.recordings[id] = recitems
+                    for name in self.reccat:
+                        if not name in recitems:
+                            BongEnvironment.logger.warning("missing element {} in recording {}".format(name, id))
+                            return status, False
+                # processed recordings are dropped from the partial tree
+                root.clear()
+        return status, True
+
     def getRecordings(self):
     
         self.recordings.clear()
+        self.listChanged = True
+        self.listCached = False
+        params = self._credentials()
         
-        if self.useCachedResponse('getRecordingsCache'):
-            xmldata = self.getCachedResponse('getRecordingsCache')
-            BongEnvironment.logger.info(u"using cached response for getRecordings()")
-            #BongEnvironment.logger.info(unicode_string(xmldata))
-            tree = ET.fromstring(xmldata)
-        else:
-            url = "http://{server}/api/recordings.xml?{credentials}".format( server = self.server
-                                                                           , credentials = urllib.urlencode({ 'username' : self.username
-                                                                                                            , 'password' : self.password }))
-            request = urllib2.Request(url)
-            response = urllib2.urlopen(request)
+        if not self.conditionalRequests:
+            cached = self.cache.lookup('recordings', params)
+            if cached is not None:
+                BongEnvironment.logger.info(u"using cached recordings for getRecordings()")
+                self._useRecordings(cached)
+                self.listCached = True
+                return True
+            f, timestamp = self.cache.open('recordings', params)
+            if f is not None:
+                BongEnvironment.logger.info(u"using cached response for getRecordings()")
+                with f:
+                    with BongMetrics.xmlParseSeconds.time(source='cache'):
+                        status, complete = self._parseRecordings(f)
+                if complete:
+                    self.cache.store('recordings', params, self._copyRecordings(), timestamp)
+                self.listCached = True
+                return complete
+
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.lastModified:
+            headers['If-Modified-Since'] = self.lastModified
+
+        url = "/api/recordings.xml"
+        with self._apiRequest(url, headers) as response:
+            if response.code == 304:
+                BongEnvironment.logger.info("{req} -> ({code!s} {message!s}), list of recordings unchanged".format( req = url
+                                                                                                       , code = response.code
+                                                                                                       , message = response.msg ))
+                self.listChanged = False
+                return True
+
             if response.code != 200:
                 BongEnvironment.logger.warning(url)
                 BongEnvironment.logger.warning("request failed ({code!s} {message!s})".format( code = response.code
@@ -131,51 +245,50 @@ class BongApi:
             BongEnvironment.logger.info("{req} -> ({code!s} {message!s})".format( req = url
                                                                      , code = response.code
                                                                      , message = response.msg ))
-            xmldata = response.read()
-            BongEnvironment.logger.info(unicode_string(xmldata))
-        
-            tree = ET.fromstring(xmldata)
 
-            if self._et_node_text(tree, "status", "false") != 'true':
-                BongEnvironment.logger.warning("response contains errors.")
-                return False
-            else:
-                self.cacheResponse('getRecordingsCache', xmldata)
-
-        # find all recording elements with an id sub-element
-        for rec in tree.findall("recording/[id]"):
-            id = self._et_node_text(rec, "id")
-            if 0 < len(id):
-                recitems = {}
-                self.recordings[id] = recitems
-                for item in rec:
-                    if item.tag != u"files":
-                        recitems[item.tag] = unescape(item.text)
-                for media in rec.findall("files/file"):
-                    if self._et_node_text(media, "type") == 'download':
-                        if self._et_node_text(media, "quality") == 'HQ':
-                            recitems["downloadHQ"] = self._et_node_text(media, "url")
-                        elif self._et_node_text(media, "quality") == 'NQ':
-                            recitems["downloadNQ"] = self._et_node_text(media, "url")
-                for name in self.reccat:
-                    if not name in recitems:
-                        BongEnvironment.logger.warning("missing element {} in recording {}".format(name, id))
-                        return False
+            etag = response.getheader('ETag')
+            lastModified = response.getheader('Last-Modified')
+
+            # the response is written to the cache while it is parsed
+            with self.cache.writer('recordings', params) as w:
+                with BongMetrics.xmlParseSeconds.time(source='network'):
+                    status, complete = self._parseRecordings(TeeReader(response, w))
+                if status != 'true' or not complete:
+                    w.discard()
+
+        if status != 'true':
+            BongEnvironment.logger.warning("response contains errors.")
+            return False
+        if not complete:
+            return False
+
+        self.cache.store('recordings', params, self._copyRecordings())
+        self.etag = etag
+        self.lastModified = lastModified
         return True
 
+    def _copyRecordings(self):
+        return dict((id, dict(kv)) for id, kv in self.recordings.items())
+
     def checkCredentials(self):
 
-        if self.useCachedResponse('checkCredentialsCache'):
-            xmldata = self.getCachedResponse('checkCredentialsCache')
+        params = self._credentials()
+        if self.cache.lookup('users', params):
+            BongEnvironment.logger.info(u"using cached result for checkCredentials")
+            return True
+
+        f, timestamp = self.cache.open('users', params)
+        if f is not None:
             BongEnvironment.logger.info(u"using cached response for checkCredentials")
-            #BongEnvironment.logger.info(unicode_string(xmldata))
-            tree = ET.fromstring(xmldata)
-        else:
-            url = "http://{server}/api/users.xml?{credentials}".format( server = self.server
-                                                                      , credentials = urllib.urlencode({ 'username' : self.username
-                                                                                                       , 'password' : self.password }))
-            request = urllib2.Request(url)
-            response = urllib2.urlopen(request)
+            with f:
+                tree = ET.parse(f).getroot()
+            valid = self._et_node_text(tree, "status", "false") == 'true'
+            if valid:
+                self.cache.store('users', params, True, timestamp)
+            return valid
+
+        url = "/api/users.xml"
+        with self._apiRequest(url) as response:
             if response.code != 200:
                 BongEnvironment.logger.warning(url)
                 BongEnvironment.logger.warning("request failed ({code!s} {message!s})".format( code = response.code
@@ -186,38 +299,42 @@ class BongApi:
                                                                      , code = response.code
                                                                      , message = response.msg ))
             xmldata = response.read()
-            BongEnvironment.logger.info(unicode_string(xmldata))
-            tree = ET.fromstring(xmldata)
+        if BongEnvironment.logger.isEnabledFor(BongLogging.DUMP):
+            BongEnvironment.logger.log(BongLogging.DUMP, unicode_string(xmldata))
+        tree = ET.fromstring(xmldata)
 
-            if self._et_node_text(tree, "status", "false") != 'true':
-                BongEnvironment.logger.warning("response contains errors.")
-                return False
-            else:
-                self.cacheResponse('checkCredentialsCache', xmldata)
+        if self._et_node_text(tree, "status", "false") != 'true':
+            BongEnvironment.logger.warning("response contains errors.")
+            return False
 
+        with self.cache.writer('users', params) as w:
+            w.write(xmldata)
+        self.cache.store('users', params, True)
         return True ;
 
 
     def deleteRecording(self, recordingID):
-        url = "http://{server}/api/recordings/{id}/delete.xml?{credentials}".format( server = self.server
-                                                                                   , id = recordingID
-                                                                                   , credentials = urllib.urlencode({ 'username' : self.username
-                                                                                                                    , 'password' : self.password }))
-        request = urllib2.Request(url)
-        response = urllib2.urlopen(request)
-        self.killCachedResponse('getRecordingsCache')
-
-        if response.code != 200:
-            BongEnvironment.logger.warning(url)
-            BongEnvironment.logger.warning("request failed ({code!s} {message!s})".format( code = response.code
-                                                                              , message = response.msg ))
-            return False
+        """
+        delete a recording on bong.tv
+        
+        Returns True if the recording was deleted and False if bong.tv
+        refused the delete, by status false or a 4xx status. Returns None
+        for other errors of the server, the delete may succeed later.
+        """
+        url = "/api/recordings/{id}/delete.xml".format(id = recordingID)
+        with self._apiRequest(url) as response:
+            if response.code != 200:
+                BongEnvironment.logger.warning(url)
+                BongEnvironment.logger.warning("request failed ({code!s} {message!s})".format( code = response.code
+                                                                                  , message = response.msg ))
+                return False if 400 <= response.code < 500 else None
 
-        BongEnvironment.logger.info("{req} -> ({code!s} {message!s})".format( req = url
-                                                                 , code = response.code
-                                                                 , message = response.msg ))
-        xmldata = response.read()
-        BongEnvironment.logger.info(unicode_string(xmldata))
+            BongEnvironment.logger.info("{req} -> ({code!s} {message!s})".format( req = url
+                                                                     , code = response.code
+                                                                     , message = response.msg ))
+            xmldata = response.read()
+        if BongEnvironment.logger.isEnabledFor(BongLogging.DUMP):
+            BongEnvironment.logger.log(BongLogging.DUMP, unicode_string(xmldata))
         tree = ET.fromstring(xmldata)
 
         if self._et_node_text(tree, "status", "false") != 'true':
@@ -227,134 +344,107 @@ class BongApi:
         return True ;
 
 
-    def registerDownload(self, bong_id):
-        con = sqlite3.connect(BongEnvironment.settings['dbfile'])
-        BongEnvironment.logger.info("opening database to mark recording {!s} as downloaded".format(bong_id))
-        con.execute("update recording set download_state = 0 where bong_id = :bong_id", {"bong_id": bong_id})
-        con.commit()
-        con.close()     
+    def registerDownload(self, bong_id, result=None):
+        """
+        mark a recording as downloaded and store digest, size and timing of its video file
+        """
+        BongEnvironment.logger.info("marking recording {!s} as downloaded".format(bong_id))
+        w = {"account": self.account, "bong_id": bong_id, "digest": None, "size": None, "started": None, "seconds": None}
+        if result is not None:
+            w.update({ "digest": result.digest
+                     , "size": result.size
+                     , "started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(result.started))
+                     , "seconds": result.seconds })
+        with BongDatabase.transaction() as con:
+            con.execute( """
+                         update recording 
+                         set    download_state = 0
+                              , video_digest = :digest
+                              , video_size = :size
+                              , download_started = :started
+                              , download_seconds = :seconds
+                         where  account = :account
+                         and    bong_id = :bong_id
+                         """
+                       , w)
     
     
     def refreshDatabase(self):
-        fieldnames = ( "bong_id"
-                     , "title"
-                     , "subtitle"
-                     , "description"
-                     , "genre"
-                     , "channel"
-                     , "start"
-                     , "duration"
-                     , "series_season"
-                     , "series_number"
-                     , "series_count"
-                     , "image_name"
-                     , "image"
-                     , "downloadHQ"
-                     , "downloadNQ"
-                     ) 
+        with BongMetrics.refreshSeconds.time():
+            return self._refreshDatabase()
+
+    def _refreshDatabase(self):
         sql = """
-              INSERT 
+              INSERT OR IGNORE
               INTO    recording 
                      ( is_downloadable
                      , download_state
-                     , bong_id
-                     , title
-                     , subtitle
-                     , description
-                     , genre
-                     , channel
-                     , start
-                     , duration
-                     , series_season
-                     , series_number
-                     , series_count
-                     , image_name
-                     , image
-                     , downloadHQ
-                     , downloadNQ
+                     , account
+                     , {columns}
                      ) 
               VALUES ( 'Y'
                      , 1
-                     ,:bong_id
-                     ,:title
-                     ,:subtitle
-                     ,:description
-                     ,:genre
-                     ,:channel
-                     ,:start
-                     ,:duration
-                     ,:series_season
-                     ,:series_number
-                     ,:series_count
-                     ,:image_name
-                     ,:image
-                     ,:downloadHQ
-                     ,:downloadNQ
+                     , ?
+                     , {values}
                      )
-                 """
+              """.format( columns = "\n                     , ".join(RECORDING_FIELDS)
+                        , values = ", ".join("?" for fn in RECORDING_FIELDS))
 
-        con = sqlite3.connect(BongEnvironment.settings['dbfile'])
-        BongEnvironment.logger.info("opening database to update available recordings")
+        complete = self.getRecordings()
 
-        con.execute("update recording set is_downloadable = 'N'")
-        con.commit()
+        # an unchanged list leaves the database as it is
+        if not self.listChanged:
+            return False
+        # the fast path compares its state with the live list, a cached list
+        # keeps the ids of the live list seen before in this run, if any
+        if not self.listCached:
+            self.listIds = set(self.recordings.keys()) if complete else None
 
-        self.getRecordings()
+        self.dumpRecordings()
 
-        for id, kv in self.recordings.items():
+        problems = []
+        rows = [(self.account,) + row for row in normalizeRecordings(self.recordings, problems)]
+        for id, field, value in problems:
+            BongEnvironment.logger.warning("{!s} missing or malformed in recording {!s}: {!r}".format(field, id, value))
 
-            self.dumpRecordings(id)    
-
-            w = {}
-            for fn in fieldnames:
-                if kv.has_key(fn):
-                    if fn == 'start':
-                        # start = '23-11-2011 20:15'
-                        #     --> '2011-11-23 20:15:00'
-                        w['start'] = bongDateTimeToSqlite(kv['start'])
-                        if w['start'] is None:
-                            BongEnvironment.logger.warning("start timestamp missing or malformed: {!s}".format(kv['start']))
-                    elif fn == 'duration':
-                        # duration = '1:50'
-                        #       --> '01:50:00'
-                        w['duration'] = bongTimeToSqlite(kv['duration'])
-                        if w['duration'] is None:
-                            BongEnvironment.logger.warning("duration missing or malformed: {!s}".format(kv['duration']))
-                    else:
-                        w[fn] = kv[fn]
-                else:
-                    if fn == 'bong_id':
-                        w['bong_id'] = kv['id']
-                    else:
-                        w[fn] = None
-
-            cur = con.cursor()
-            cur.execute("select id, download_state from recording where bong_id = :bong_id", {"bong_id": id})
-            rec = cur.fetchone() 
-            cur.close()
-            
-            if rec: 
-                kv['db_id'] = rec[0]
-                if 0 == rec[1]:
-                    BongEnvironment.logger.info(u"recording with bong_id {!s} has already been downloaded".format(id))
-                    del self.recordings[id]
+        # all changes of a refresh are written in a single transaction
+        BongEnvironment.logger.info("updating available recordings in database")
+        with BongDatabase.transaction() as con:
+            con.execute("update recording set is_downloadable = 'N' where account = ?", (self.account,))
+            # other processes cannot insert before this transaction ends
+            lastId = con.execute("select max(id) from recording").fetchone()[0] or 0
+            cur = con.executemany(sql, rows)
+            BongEnvironment.logger.info(u"{!s} new records inserted".format(cur.rowcount))
+            BongIndex.update(con, lastId)
+            con.executemany("update recording set is_downloadable = 'Y' where account = ? and bong_id = ?", [row[:2] for row in rows])
+            known = {}
+            leased = set()
+            # recordings leased by other processes are left to them
+            condition, params = BongLease.availableCondition()
+            for bong_id, db_id, download_state, available in con.execute( "select bong_id, id, download_state, " + condition + " from recording where account = ? and is_downloadable = 'Y'"
+                                                                        , params + (self.account,)):
+                if available:
+                    known[bong_id] = (db_id, download_state)
                 else:
-                    BongEnvironment.logger.info(u"existing record for bong_id {!s} found".format(id))
-                    con.execute("update recording set is_downloadable = 'Y' where bong_id = :bong_id", {"bong_id": id})
-                    con.commit()
+                    leased.add(bong_id)
+
+        self.conflicts = set()
+        for id, kv in self.recordings.items():
+            if id in leased:
+                BongEnvironment.logger.info(LazyMessage(u"recording with bong_id {!s} leased by another process", id))
+                del self.recordings[id]
+            elif id not in known:
+                # another recording of the account has the same channel and start or video URL
+                BongEnvironment.logger.warning(u"recording with bong_id {!s} conflicts with a stored recording and was not inserted".format(id))
+                self.conflicts.add(id)
+                del self.recordings[id]
+            elif 0 == known[id][1]:
+                BongEnvironment.logger.debug(LazyMessage(u"recording with bong_id {!s} has already been downloaded", id))
+                del self.recordings[id]
+            elif BongDuplicates.SKIPPED == known[id][1]:
+                BongEnvironment.logger.debug(LazyMessage(u"recording with bong_id {!s} has been skipped as duplicate", id))
+                del self.recordings[id]
             else:
-                cur = con.cursor()
-                try:
-                    cur.execute(sql, w)
-                    kv['db_id'] = cur.lastrowid
-                    con.commit()
-                    BongEnvironment.logger.info(u"new record for bong_id {!s} inserted".format(id))
-                except:
-                    BongEnvironment.logger.info(u"insert with bong_id {!s} failed:".format(id))
-                    for x in sys.exc_info():
-                        BongEnvironment.logger.info(x)
-                cur.close()
-
-        con.close()     
+                kv['db_id'] = known[id][0]
         
-        return (0 < len(self.recordings))
\ No newline at end of file
+        return (0 < len(self.recordings))
@@ -0,0 +1,260 @@
+"""
+Concurrent download of artwork into a content-addressed cache
+
+As soon as the list of recordings has been refreshed, the image URLs of
+all recordings are handed to a small pool of threads, independent of the
+video downloads. Each URL is fetched once and stored in the artwork cache
+below the recordings directory under the SHA-256 digest of its content,
+so episodes sharing an image, even under different URLs, share one file.
+The artwork table of the recordings database maps URLs to digests, so
+later runs do not fetch known images again. When a recording has been
+downloaded, its image is hard linked from the cache into the recording
+directory, or copied where hard links are not available.
+
+The cache is limited to maxBytes: after every pass over the recordings
+the images used least recently are removed until it fits. Recordings
+keep their linked or copied images, an evicted image is fetched again
+if a later recording needs it.
+"""
+import os
+import os.path
+import shutil
+import socket
+import hashlib
+import threading
+import urllib2
+import Queue
+import BongEnvironment
+import BongHttp
+import BongDatabase
+import BongBandwidth
+import BongMetrics
+
+
+CHUNK_SIZE = 2**16
+# images are not worth as many attempts as videos
+RETRIES = 3
+
+
+class _Entry:
+    """
+    the state of one image URL, complete once fetched or failed
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.path = None
+        self.done = threading.Event()
+
+
+class Pipeline:
+
+    def __init__(self, directory, workers=4, maxBytes=0):
+        self.directory = directory
+        self.workers = max(1, workers)
+        self.maxBytes = maxBytes
+        self.fetched = 0
+        self.hits = 0
+        self.failed = 0
+        self.evicted = 0
+        self._entries = {}
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        BongMetrics.queueDepth.setFunction(self._queue.qsize, queue='artwork')
+
+    def _known(self, urls):
+        """
+        return the cached files of those urls which have been fetched before
+        """
+        known = {}
+        with BongDatabase.transaction() as con:
+            for url in urls:
+                row = con.execute("select filename from artwork where url = ?", (url,)).fetchone()
+                if row is not None:
+                    path = os.path.join(self.directory, row[0])
+                    if os.path.isfile(path):
+                        known[url] = path
+        return known
+
+    def prefetch(self, recordings):
+        """
+        start fetching the images of the given (id, kv) pairs which are not known yet
+        """
+        with self._lock:
+            urls = set(kv['image'] for id, kv in recordings if kv.get('image') and kv['image'] not in self._entries)
+            if not urls:
+                return
+            known = self._known(urls)
+            for url in urls:
+                entry = self._entries[url] = _Entry(url)
+                if url in known:
+                    entry.path = known[url]
+                    entry.done.set()
+                    self.hits += 1
+                    BongMetrics.cacheRequests.inc(endpoint='artwork', result='disk hit')
+                else:
+                    self._queue.put(entry)
+                    BongMetrics.cacheRequests.inc(endpoint='artwork', result='miss')
+            while len(self._threads) < min(self.workers, self._queue.qsize()):
+                t = threading.Thread(target=self._worker, name="BongArtwork-{!s}".format(len(self._threads)))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def _worker(self):
+        while True:
+            entry = self._queue.get()
+            try:
+                entry.path = self._fetch(entry.url)
+            except Exception:
+                BongEnvironment.logger.exception("fetching image {!s} failed".format(entry.url))
+            finally:
+                if entry.path is None:
+                    # forgotten, so a later prefetch tries again
+                    with self._lock:
+                        self.failed += 1
+                        self._entries.pop(entry.url, None)
+                entry.done.set()
+
+    def _fetch(self, url):
+        """
+        download url into the cache and return the path of the cached file, or None
+        """
+        meter = BongBandwidth.Meter(BongBandwidth.governor())
+        extension = os.path.splitext(url.split('?', 1)[0])[1]
+        tmpname = os.path.join(self.directory, "{!s}.{!s}.tmp".format(os.getpid(), threading.current_thread().ident))
+        for attempt in xrange(RETRIES):
+            if attempt:
+                BongMetrics.retries.inc(operation='artwork')
+            h = hashlib.sha256()
+            try:
+                response = urllib2.urlopen(urllib2.Request(url, headers={'User-Agent': BongHttp.USER_AGENT}), timeout=BongHttp.TIMEOUT)
+                try:
+                    with open(tmpname, 'wb') as f:
+                        while True:
+                            data = response.read(CHUNK_SIZE)
+                            if not data:
+                                break
+                            meter.consume(len(data))
+                            f.write(data)
+                            h.update(data)
+                finally:
+                    response.close()
+            except (urllib2.URLError, IOError, socket.error), e:
+                BongEnvironment.logger.warning("fetching image {!s} failed ({!s}), attempt {!s}".format(url, e, attempt + 1))
+                continue
+            filename = h.hexdigest() + extension
+            path = os.path.join(self.directory, filename)
+            if os.path.isfile(path):
+                # same content under another URL
+                os.remove(tmpname)
+            else:
+                if os.name == 'posix':
+                    statinfo = os.stat(BongEnvironment.settings['recdir'])
+                    os.chmod(tmpname, 0666)
+                    os.chown(tmpname, statinfo.st_uid, statinfo.st_gid)
+                os.rename(tmpname, path)
+            with BongDatabase.transaction() as con:
+                con.execute( "insert or replace into artwork (url, filename, fetched) values (?, ?, datetime('now'))"
+                           , (url, filename))
+            with self._lock:
+                self.fetched += 1
+            return path
+        if os.path.isfile(tmpname):
+            os.remove(tmpname)
+        return None
+
+    def install(self, url, targetfile):
+        """
+        wait for the image at url and link it to targetfile, return False if it is not available
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry is None:
+            self.prefetch([(None, {'image': url})])
+            with self._lock:
+                entry = self._entries.get(url)
+            if entry is None:
+                return False
+        entry.done.wait()
+        if entry.path is None:
+            return False
+        if os.path.isfile(targetfile):
+            os.remove(targetfile)
+        try:
+            # the modification time tells evict() when the image was used last
+            os.utime(entry.path, None)
+            try:
+                os.link(entry.path, targetfile)
+            except (AttributeError, OSError):
+                # no hard links on this platform or across file systems
+                shutil.copyfile(entry.path, targetfile)
+        except (IOError, OSError), e:
+            BongEnvironment.logger.warning("installing image {!s} failed ({!s})".format(url, e))
+            with self._lock:
+                self._entries.pop(url, None)
+            return False
+        return True
+
+    def evict(self):
+        """
+        remove the least recently used images until the cache fits into maxBytes
+        """
+        if self.maxBytes <= 0:
+            return
+        with self._lock:
+            # images still being fetched or waited for are kept
+            pending = set(os.path.basename(e.path) for e in self._entries.itervalues() if e.path and not e.done.is_set())
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                fn = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+                total += st.st_size
+                if not name.endswith('.tmp') and name not in pending:
+                    entries.append((st.st_mtime, st.st_size, name))
+            entries.sort()
+            removed = []
+            while entries and total > self.maxBytes:
+                mtime, size, name = entries.pop(0)
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                total -= size
+                removed.append(name)
+            if not removed:
+                return
+            # forget the evicted images, so they are fetched again when needed
+            gone = set(os.path.join(self.directory, name) for name in removed)
+            for url in [url for url, e in self._entries.iteritems() if e.path in gone]:
+                del self._entries[url]
+            self.evicted += len(removed)
+        with BongDatabase.transaction() as con:
+            con.executemany("delete from artwork where filename = ?", [(name,) for name in removed])
+        BongEnvironment.logger.info("evicted {!s} images from the artwork cache".format(len(removed)))
+
+    def logStatistics(self):
+        BongEnvironment.logger.info("artwork: {!s} fetched, {!s} known, {!s} failed, {!s} evicted".format(self.fetched, self.hits, self.failed, self.evicted))
+
+
+_pipeline = None
+_pipelineLock = threading.Lock()
+
+
+def pipeline():
+    """
+    return the artwork pipeline shared by all accounts of the process
+    """
+    global _pipeline
+    with _pipelineLock:
+        if _pipeline is None:
+            _pipeline = Pipeline( BongEnvironment.settings['artworkdir'], BongEnvironment.settings['artworkWorkers']
+                                , BongEnvironment.settings['artworkMaxBytes'])
+        return _pipeline
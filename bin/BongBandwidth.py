@@ -0,0 +1,169 @@
+"""
+Bandwidth limit shared by all transfers of the process
+
+A single token bucket governs the download rate of every transfer. The
+rate depends on the time of day according to profiles in the [bandwidth]
+section of the configuration file:
+
+    [bandwidth]
+    default = 0
+    office = 08:00-18:00 2048
+    night = 01:00-07:00 0
+
+Rates are given in KiB/s, 0 means unlimited. The default rate applies
+outside all time windows, windows may span midnight. The configuration
+file is checked for changes while transfers are running, so a new limit
+takes effect without restarting the download manager.
+"""
+import os
+import re
+import time
+import threading
+import ConfigParser
+import BongEnvironment
+
+
+# seconds between checks of the configuration file for changes
+RELOAD_INTERVAL = 10
+
+
+def readProfiles(config):
+    """
+    return the default rate and a list of (first minute, last minute, rate)
+    windows from the [bandwidth] section, rates converted to byte/s
+    """
+    default = 0
+    windows = []
+    if not config.has_section('bandwidth'):
+        return default, windows
+    pattern = re.compile("^([0-2]?[0-9]):([0-5][0-9])\s*-\s*([0-2]?[0-9]):([0-5][0-9])\s+([0-9]+)$")
+    for name in config.options('bandwidth'):
+        value = config.get('bandwidth', name).strip()
+        if name == 'default':
+            if value.isdigit():
+                default = int(value) * 1024
+            else:
+                BongEnvironment.logger.warning("malformed default bandwidth {!r}".format(value))
+            continue
+        m = pattern.match(value)
+        if m:
+            first = int(m.group(1)) * 60 + int(m.group(2))
+            last = int(m.group(3)) * 60 + int(m.group(4))
+            windows.append((first, last, int(m.group(5)) * 1024))
+        else:
+            BongEnvironment.logger.warning("malformed bandwidth profile {!s} = {!r}".format(name, value))
+    return default, windows
+
+
+class Governor:
+    """
+    token bucket shared by all transfers
+
+    Transfers call consume() for every chunk of data they receive. When the
+    bucket is empty the calling thread sleeps until the data fits into the
+    current rate; the time spent waiting is returned to the caller.
+    """
+
+    def __init__(self, inifile=None):
+        self.inifile = inifile
+        self.default = 0
+        self.windows = []
+        self.rate = 0
+        self.tokens = 0.0
+        self.updated = time.time()
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._reload(time.time())
+
+    def _reload(self, now):
+        """
+        read the profiles again if the configuration file has changed
+        """
+        self._checked = now
+        if self.inifile is None:
+            return
+        try:
+            mtime = os.path.getmtime(self.inifile)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        config = ConfigParser.SafeConfigParser()
+        config.read(self.inifile)
+        self.default, self.windows = readProfiles(config)
+        self._mtime = mtime
+        BongEnvironment.logger.info("bandwidth profiles: default {!s} byte/s, windows {!r}".format(self.default, self.windows))
+
+    def currentRate(self, now=None):
+        """
+        rate in byte/s for the given time, 0 meaning unlimited
+        """
+        t = time.localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        for first, last, rate in self.windows:
+            if first <= last:
+                if first <= minute < last:
+                    return rate
+            elif minute >= first or minute < last:
+                return rate
+        return self.default
+
+    def consume(self, amount):
+        """
+        account for amount bytes received and wait if the rate is exceeded
+
+        Returns the number of seconds the caller has been throttled
+        """
+        with self._lock:
+            now = time.time()
+            if now - self._checked >= RELOAD_INTERVAL:
+                self._reload(now)
+            rate = self.currentRate(now)
+            if rate != self.rate:
+                self.rate = rate
+                self.tokens = float(rate)
+            if rate <= 0:
+                self.updated = now
+                return 0.0
+            # refill, allowing a burst of at most one second
+            self.tokens = min(float(rate), self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            wait = -self.tokens / rate
+        time.sleep(wait)
+        return wait
+
+
+class Meter:
+    """
+    a single transfer's view of the shared governor, summing up its throttled time
+    """
+
+    def __init__(self, governor):
+        self.governor = governor
+        self.throttled = 0.0
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        wait = self.governor.consume(amount)
+        if 0 < wait:
+            with self._lock:
+                self.throttled += wait
+
+
+_governor = None
+_governorLock = threading.Lock()
+
+
+def governor():
+    """
+    return the governor shared by all transfers of the process
+    """
+    global _governor
+    with _governorLock:
+        if _governor is None:
+            _governor = Governor(BongEnvironment.settings.get('inifile'))
+        return _governor
@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+"""
+Bong.tv Download Manager benchmark
+
+Runs BongDownload.work() against a local stand-in for the bong.tv server
+and reports wall time, throughput, API calls and time spent in SQLite.
+The stand-in implements /api/users.xml, /api/recordings.xml and
+/api/recordings/{id}/delete.xml for a synthetic catalog and serves
+synthetic video and image files. Latency, bandwidth and range support
+of the server are configurable. The download manager works on a
+temporary dta/rec/log tree, so the real installation is not touched.
+
+Example:
+
+    python BongBenchmark.py --recordings 1000 --video-size 2000000 --latency 20
+
+With --normalize the script instead times the conversion of parsed
+recordings into database rows, comparing the former per-field loop with
+BongLibrary.normalizeRecordings():
+
+    python BongBenchmark.py --normalize 100000
+"""
+import os
+import os.path
+import re
+import sys
+import time
+import shutil
+import random
+import tempfile
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+
+class Catalog:
+    """
+    synthetic recordings of the stand-in server
+    """
+
+    CHANNELS = (u'ARD', u'ZDF', u'arte', u'3sat', u'Das Erste HD', u'WDR')
+    GENRES = (u'Spielfilm', u'Serie', u'Dokumentation', u'Nachrichten', u'Sport')
+
+    def __init__(self, count, videoSize, imageSize, sharedImages):
+        self.count = count
+        self.videoSize = videoSize
+        self.imageSize = imageSize
+        self.sharedImages = sharedImages
+        self.deleted = set()
+        self.lock = threading.Lock()
+        rnd = random.Random(4711)
+        self.block = ''.join(chr(rnd.randint(0, 255)) for i in xrange(2**16))
+
+    def ids(self):
+        with self.lock:
+            return [i for i in xrange(1, self.count + 1) if i not in self.deleted]
+
+    def delete(self, id):
+        with self.lock:
+            if id in self.deleted or not 1 <= id <= self.count:
+                return False
+            self.deleted.add(id)
+            return True
+
+    def content(self, offset, length):
+        """
+        bytes offset..offset+length of a synthetic file
+        """
+        chunks = []
+        size = len(self.block)
+        while 0 < length:
+            start = offset % size
+            piece = self.block[start:start + length]
+            chunks.append(piece)
+            offset += len(piece)
+            length -= len(piece)
+        return ''.join(chunks)
+
+    def recordingXml(self, base, id):
+        minutes = id * 7
+        day = 1 + (minutes // 1440) % 28
+        month = 1 + (minutes // (1440 * 28)) % 12
+        year = 2011 + minutes // (1440 * 28 * 12)
+        if self.sharedImages:
+            image = "{}/media/image/{!s}.jpg".format(base, id % 10)
+        else:
+            image = "{}/media/image/{!s}.jpg".format(base, id)
+        return ( u"<recording>"
+                 u"<id>{id!s}</id>"
+                 u"<title>Sendung {series!s}</title>"
+                 u"<subtitle>Folge {id!s}</subtitle>"
+                 u"<description>Beschreibung der Folge {id!s} mit &amp;amp; Sonderzeichen. {filler}</description>"
+                 u"<channel>{channel}</channel>"
+                 u"<genre>{genre}</genre>"
+                 u"<start>{day!s}-{month!s}-{year!s} {hour!s}:{minute:02d}</start>"
+                 u"<duration>{dh!s}:{dm:02d}</duration>"
+                 u"<image_name>image{id!s}</image_name>"
+                 u"<image>{image}</image>"
+                 u"<series_season>{season!s}</series_season>"
+                 u"<series_number>{number!s}</series_number>"
+                 u"<series_count>20</series_count>"
+                 u"<files>"
+                 u"<file><type>download</type><quality>HQ</quality><url>{base}/media/video/{id!s}.mp4</url></file>"
+                 u"<file><type>download</type><quality>NQ</quality><url>{base}/media/video/{id!s}.nq.mp4</url></file>"
+                 u"</files>"
+                 u"</recording>").format( id = id
+                                        , series = id % 50
+                                        , filler = u"Lorem ipsum " * 10
+                                        , channel = self.CHANNELS[id % len(self.CHANNELS)]
+                                        , genre = self.GENRES[id % len(self.GENRES)]
+                                        , day = day, month = month, year = year
+                                        , hour = (minutes // 60) % 24, minute = minutes % 60
+                                        , dh = id % 3, dm = 5 + id % 50
+                                        , image = image
+                                        , season = 1 + id % 5, number = 1 + id % 20
+                                        , base = base )
+
+    def recordingsXml(self, base):
+        parts = [u"<?xml version=\"1.0\" encoding=\"UTF-8\"?><response><status>true</status>"]
+        for id in self.ids():
+            parts.append(self.recordingXml(base, id))
+        parts.append(u"</response>")
+        return u"".join(parts).encode('utf-8')
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, catalog, latency, bandwidth, ranges):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.catalog = catalog
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.ranges = ranges
+        self.calls = {}
+        self.bytesServed = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def base(self):
+        return "http://127.0.0.1:{!s}".format(self.server_address[1])
+
+    def count(self, endpoint, size=0):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            self.bytesServed += size
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, body, contentType='text/xml', headers=None, send=True):
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if send:
+            self.wfile.write(body)
+
+    def _status(self, ok):
+        return '<?xml version="1.0" encoding="UTF-8"?><response><status>{}</status></response>'.format('true' if ok else 'false')
+
+    def _media(self, endpoint, length, send):
+        """
+        serve a synthetic file, honouring range requests if enabled
+        """
+        server = self.server
+        first, last = 0, length - 1
+        code = 200
+        headers = {'ETag': '"{!s}"'.format(length)}
+        if server.ranges:
+            headers['Accept-Ranges'] = 'bytes'
+            m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.getheader('Range', ''))
+            if m:
+                first = int(m.group(1))
+                if m.group(2):
+                    last = min(int(m.group(2)), length - 1)
+                code = 206
+                headers['Content-Range'] = 'bytes {!s}-{!s}/{!s}'.format(first, last, length)
+        size = max(0, last - first + 1)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        server.count(endpoint, size if send else 0)
+        if not send:
+            return
+        position = first
+        chunk = 2**16
+        while position <= last:
+            n = min(chunk, last - position + 1)
+            started = time.time()
+            self.wfile.write(server.catalog.content(position, n))
+            position += n
+            if 0 < server.bandwidth:
+                delay = float(n) / server.bandwidth - (time.time() - started)
+                if 0 < delay:
+                    time.sleep(delay)
+
+    def _handle(self, send):
+        server = self.server
+        if 0 < server.latency:
+            time.sleep(server.latency)
+        path = self.path.split('?', 1)[0]
+        m = re.match(r'^/api/recordings/(\d+)/delete\.xml$', path)
+        if path == '/api/users.xml':
+            server.count('users')
+            self._send(200, self._status(True), send=send)
+        elif path == '/api/recordings.xml':
+            body = server.catalog.recordingsXml(server.base())
+            server.count('recordings', len(body))
+            self._send(200, body, send=send)
+        elif m:
+            server.count('delete')
+            self._send(200, self._status(server.catalog.delete(int(m.group(1)))), send=send)
+        elif path.startswith('/media/video/'):
+            self._media('video', server.catalog.videoSize, send)
+        elif path.startswith('/media/image/'):
+            self._media('image', server.catalog.imageSize, send)
+        else:
+            server.count('unknown')
+            self._send(404, 'not found', 'text/plain', send=send)
+
+    def do_GET(self):
+        self._handle(True)
+
+    def do_HEAD(self):
+        self._handle(False)
+
+
+def _prepareTree(root, options, server):
+    """
+    create bin/dta/rec/log directories with settings pointing to the stand-in server
+    """
+    sourcedir = os.path.dirname(os.path.abspath(__file__))
+    for d in ('bin', 'dta', 'rec', 'log'):
+        os.mkdir(os.path.join(root, d))
+    shutil.copy(os.path.join(sourcedir, '..', 'dta', 'Recordings.db'), os.path.join(root, 'dta'))
+    with open(os.path.join(root, 'dta', 'Settings.ini'), 'w') as f:
+        f.write( "[bong.tv]\n"
+                 "username = benchmark\n"
+                 "password = benchmark\n"
+                 "server = 127.0.0.1:{port!s}\n"
+                 "\n"
+                 "[options]\n"
+                 "verbose = false\n"
+                 "cacheLifeInMinutes = 0\n"
+                 "downloadWorkers = {workers!s}\n"
+                 "downloadSegments = {segments!s}\n"
+                 "downloadEngine = {engine!s}\n"
+                 "deleteBatchSize = 10\n"
+                 "\n"
+                 "[postprocess]\n"
+                 "steps = {postprocess!s}\n".format( port = server.server_address[1]
+                                                 , workers = options.workers
+                                                 , segments = options.segments
+                                                 , engine = options.engine
+                                                 , postprocess = options.postprocess ))
+    return os.path.join(root, 'bin', 'BongDownloadManager.py')
+
+
+def _directorySize(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fn in filenames:
+            total += os.path.getsize(os.path.join(dirpath, fn))
+    return total
+
+
+def run(options):
+    """
+    run one benchmark and return a dictionary of results
+    """
+    catalog = Catalog(options.recordings, options.video_size, options.image_size, options.shared_images)
+    server = StandInServer(catalog, options.latency / 1000.0, options.bandwidth * 1024, not options.no_ranges)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    root = tempfile.mkdtemp(prefix='bongbench-')
+    try:
+        mainScript = _prepareTree(root, options, server)
+
+        # imported late, so the modules initialize against the temporary tree
+        import BongEnvironment
+        import BongDownload
+        import BongDatabase
+        BongEnvironment.initializeEnvironment(mainScript)
+        BongDatabase.statistics['transactions'] = 0
+        BongDatabase.statistics['seconds'] = 0.0
+
+        started = time.time()
+        cpu = sum(os.times()[:2])
+        BongDownload.work()
+        wall = time.time() - started
+        # the stand-in server runs in the same process, its share is the same for every engine
+        cpu = sum(os.times()[:2]) - cpu
+
+        downloaded = _directorySize(os.path.join(root, 'rec'))
+        results = { 'recordings': options.recordings
+                  , 'wall seconds': wall
+                  , 'bytes downloaded': downloaded
+                  , 'bytes/s': downloaded / wall if wall else 0.0
+                  , 'cpu seconds': cpu
+                  , 'cpu ns/byte': cpu * 1e9 / downloaded if downloaded else 0.0
+                  , 'api calls': sum(n for e, n in server.calls.items() if e not in ('video', 'image'))
+                  , 'calls by endpoint': dict(server.calls)
+                  , 'server connections': server.connections
+                  , 'remaining recordings': len(catalog.ids())
+                  , 'sqlite transactions': BongDatabase.statistics['transactions']
+                  , 'sqlite seconds': BongDatabase.statistics['seconds']
+                  }
+    finally:
+        server.shutdown()
+        server.server_close()
+        if options.keep:
+            print "benchmark tree kept in {}".format(root)
+        else:
+            shutil.rmtree(root)
+    return results
+
+
+def _legacyDateTime(bts):
+    # conversion as done before normalizeRecordings(), compiling the pattern per call
+    m = re.match("^([0-3]?[0-9])-([0-1]?[0-9])-(2[0-9]{3}) ([0-2]?[0-9]):([0-5]?[0-9])$", bts)
+    if m:
+        return "{}-{}-{} {}:{}:00".format(m.group(3), m.group(2).zfill(2), m.group(1).zfill(2), m.group(4).zfill(2), m.group(5).zfill(2))
+    return None
+
+def _legacyTime(bts):
+    m = re.match("^([0-2]?[0-9]):([0-5]?[0-9])$", bts)
+    if m:
+        return "{}:{}:00".format(m.group(1).zfill(2), m.group(2).zfill(2))
+    return None
+
+def _legacyRows(recordings, fieldnames):
+    rows = []
+    for id, kv in recordings.items():
+        w = {}
+        for fn in fieldnames:
+            if kv.has_key(fn):
+                if fn == 'start':
+                    w['start'] = _legacyDateTime(kv['start'])
+                elif fn == 'duration':
+                    w['duration'] = _legacyTime(kv['duration'])
+                else:
+                    w[fn] = kv[fn]
+            else:
+                if fn == 'bong_id':
+                    w['bong_id'] = kv['id']
+                else:
+                    w[fn] = None
+        rows.append(w)
+    return rows
+
+def normalize(count, rounds=3):
+    """
+    time the conversion of count synthetic recordings into database rows
+    and return a dictionary of results
+    """
+    import BongLibrary
+    rnd = random.Random(count)
+    recordings = {}
+    for n in xrange(count):
+        id = unicode(1000000 + n)
+        recordings[id] = { 'id': id
+                         , 'title': u'Title {!s}'.format(n)
+                         , 'subtitle': u'Episode {!s}'.format(n % 50)
+                         , 'description': u'Description of recording {!s}'.format(n)
+                         , 'genre': rnd.choice(Catalog.GENRES)
+                         , 'channel': rnd.choice(Catalog.CHANNELS)
+                         , 'start': u'{!s}-11-2011 {!s}:{:02d}'.format(1 + n % 28, n % 24, 15 * (n % 4))
+                         , 'duration': rnd.choice((u'0:30', u'0:45', u'1:30', u'1:50'))
+                         , 'series_season': None
+                         , 'series_number': None
+                         , 'series_count': None
+                         , 'image_name': u'{!s}.jpg'.format(id)
+                         , 'image': u'http://localhost/image/{!s}.jpg'.format(id)
+                         , 'downloadHQ': u'http://localhost/video/{!s}_HQ.mp4'.format(id)
+                         , 'downloadNQ': u'http://localhost/video/{!s}_NQ.mp4'.format(id)
+                         }
+
+    def best(function):
+        seconds = []
+        for r in xrange(rounds):
+            started = time.time()
+            function()
+            seconds.append(time.time() - started)
+        return min(seconds)
+
+    legacy = best(lambda: _legacyRows(recordings, BongLibrary.RECORDING_FIELDS))
+    batch = best(lambda: BongLibrary.normalizeRecordings(recordings))
+    return { 'recordings': count
+           , 'legacy seconds': legacy
+           , 'normalize seconds': batch
+           , 'speedup': legacy / batch if batch else 0.0
+           }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the Bong.tv Download Manager against a local stand-in server")
+    parser.add_argument('--recordings', type=int, default=100, help="number of recordings in the catalog")
+    parser.add_argument('--video-size', type=int, default=2**21, help="size of each video file in bytes")
+    parser.add_argument('--image-size', type=int, default=2**14, help="size of each image file in bytes")
+    parser.add_argument('--shared-images', action='store_true', help="let recordings share ten image URLs")
+    parser.add_argument('--latency', type=float, default=0, help="server latency per request in milliseconds")
+    parser.add_argument('--bandwidth', type=int, default=0, help="server bandwidth per connection in KiB/s, 0 is unlimited")
+    parser.add_argument('--no-ranges', action='store_true', help="do not advertise or honour range requests")
+    parser.add_argument('--workers', type=int, default=2, help="downloadWorkers setting")
+    parser.add_argument('--segments', type=int, default=1, help="downloadSegments setting")
+    parser.add_argument('--engine', choices=('builtin', 'urlgrabber'), default='builtin', help="downloadEngine setting")
+    parser.add_argument('--postprocess', default='', metavar='STEPS', help="comma separated post-processing steps")
+    parser.add_argument('--keep', action='store_true', help="keep the temporary tree for inspection")
+    parser.add_argument('--normalize', type=int, default=0, metavar='N', help="only time the conversion of N recordings into database rows")
+    options = parser.parse_args()
+
+    if options.normalize:
+        results = normalize(options.normalize)
+        for k in sorted(results.keys()):
+            print "{:<22} {!s}".format(k, results[k])
+        return
+
+    results = run(options)
+    for k in sorted(results.keys()):
+        print "{:<22} {!s}".format(k, results[k])
+    if results['remaining recordings']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Cache for responses of the bong.tv API
+
+Responses are cached per endpoint and request parameters in two tiers.
+The memory tier keeps parsed results for the lifetime of the process, so
+a fresh entry can be used without parsing XML again. The disk tier keeps
+the raw response in the cache directory below ../dta, so later runs of
+the script can skip the request. Each endpoint has its own time to live.
+Disk entries are written to a temporary file and renamed when complete,
+and the oldest entries are evicted when the cache directory grows beyond
+its size limit. The cache files of earlier versions, kept directly in
+../dta, are removed.
+"""
+import os
+import os.path
+import time
+import hashlib
+import threading
+import BongEnvironment
+import BongMetrics
+
+
+# single-file caches of earlier versions in the parent of the cache directory
+_LEGACY_FILES = ('getRecordings.cache', 'checkCredentials.cache')
+
+
+class NullWriter:
+    """
+    CacheWriter of endpoints which are not cached, drops all data
+    """
+
+    def write(self, data):
+        pass
+
+    def discard(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class CacheWriter:
+    """
+    temporary file receiving a response, renamed into the cache when complete
+
+    Used as a context manager. The entry is committed when the block ends
+    without an exception unless discard() has been called.
+    """
+
+    def __init__(self, cache, filename):
+        self.cache = cache
+        self.filename = filename
+        self.tmpname = "{}.{!s}.{!s}.tmp".format(filename, os.getpid(), threading.current_thread().ident)
+        self.file = None
+        self.discarded = False
+
+    def write(self, data):
+        self.file.write(data)
+
+    def discard(self):
+        self.discarded = True
+
+    def __enter__(self):
+        self.file = open(self.tmpname, 'wb')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is None and not self.discarded:
+            if os.name != 'posix' and os.path.isfile(self.filename):
+                os.remove(self.filename)
+            os.rename(self.tmpname, self.filename)
+            self.cache.evict()
+        else:
+            os.remove(self.tmpname)
+        return False
+
+
+class ResponseCache:
+
+    def __init__(self, directory, ttls, defaultTtl=0, maxBytes=0):
+        """
+        ttls maps endpoint names to their time to live in seconds, endpoints
+        not listed use defaultTtl. A time to live of 0 disables caching.
+        maxBytes limits the size of the disk tier, 0 means unlimited.
+        """
+        self.directory = directory
+        self.ttls = ttls
+        self.defaultTtl = defaultTtl
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self._memory = {}
+        self._lock = threading.RLock()
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        for name in _LEGACY_FILES:
+            fn = os.path.join(os.path.dirname(directory), name)
+            if os.path.isfile(fn):
+                os.remove(fn)
+                BongEnvironment.logger.info("removed legacy cache file {!s}".format(fn))
+
+    def _key(self, endpoint, params):
+        # parameters contain credentials, so only their digest becomes part of the filename
+        items = sorted((params or {}).items())
+        digest = hashlib.sha1(repr(items)).hexdigest()
+        return "{}-{}".format(endpoint, digest)
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.cache')
+
+    def ttl(self, endpoint):
+        return self.ttls.get(endpoint, self.defaultTtl)
+
+    def lookup(self, endpoint, params=None):
+        """
+        return the parsed result kept in memory, or None if there is no fresh one
+        """
+        ttl = self.ttl(endpoint)
+        key = self._key(endpoint, params)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if 0 < ttl and time.time() - entry[0] < ttl:
+                    self.hits += 1
+                    BongMetrics.cacheRequests.inc(endpoint=endpoint, result='memory hit')
+                    return entry[1]
+                del self._memory[key]
+        return None
+
+    def store(self, endpoint, params, value, timestamp=None):
+        """
+        keep a parsed result in memory
+        """
+        if 0 < self.ttl(endpoint):
+            with self._lock:
+                self._memory[self._key(endpoint, params)] = (timestamp or time.time(), value)
+
+    def open(self, endpoint, params=None):
+        """
+        return the cached response file and its timestamp, or (None, None) if
+        there is no fresh entry on disk
+        """
+        ttl = self.ttl(endpoint)
+        fn = self._filename(self._key(endpoint, params))
+        if 0 < ttl:
+            try:
+                mtime = os.path.getmtime(fn)
+                if time.time() - mtime < ttl:
+                    f = open(fn, 'rb')
+                    with self._lock:
+                        self.diskHits += 1
+                    BongMetrics.cacheRequests.inc(endpoint=endpoint, result='disk hit')
+                    return f, mtime
+            except (IOError, OSError):
+                pass
+        with self._lock:
+            self.misses += 1
+        BongMetrics.cacheRequests.inc(endpoint=endpoint, result='miss')
+        return None, None
+
+    def writer(self, endpoint, params=None):
+        """
+        return a CacheWriter for a response to be stored on disk
+        """
+        if self.ttl(endpoint) <= 0:
+            return NullWriter()
+        return CacheWriter(self, self._filename(self._key(endpoint, params)))
+
+    def invalidate(self, endpoint, params=None):
+        key = self._key(endpoint, params)
+        with self._lock:
+            self._memory.pop(key, None)
+            fn = self._filename(key)
+            if os.path.isfile(fn):
+                os.remove(fn)
+
+    def evict(self):
+        """
+        remove the oldest disk entries until the cache fits into maxBytes
+        """
+        if self.maxBytes <= 0:
+            return
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if name.endswith('.cache'):
+                    fn = os.path.join(self.directory, name)
+                    try:
+                        st = os.stat(fn)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, fn))
+                    total += st.st_size
+            entries.sort()
+            while entries and total > self.maxBytes:
+                mtime, size, fn = entries.pop(0)
+                os.remove(fn)
+                total -= size
+                BongEnvironment.logger.info("evicted {!s} from response cache".format(fn))
+
+    def logStatistics(self):
+        BongEnvironment.logger.info("response cache: {!s} memory hits, {!s} disk hits, {!s} misses".format(self.hits, self.diskHits, self.misses))
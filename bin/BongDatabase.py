@@ -0,0 +1,254 @@
+"""
+Access to the recordings database
+
+All database work of the Bong Download Manager goes through a single
+long-lived connection to ../dta/Recordings.db. The connection is opened
+on first use, switched to write-ahead logging and checked for the
+indexes the download manager relies on. Since download workers run in
+several threads, access to the connection is serialized by a lock.
+"""
+import time
+import sqlite3
+import threading
+import contextlib
+import BongEnvironment
+import BongMetrics
+
+
+_connection = None
+_lock = threading.RLock()
+
+# number of transactions and seconds spent in them, including waits for the lock
+statistics = {'transactions': 0, 'seconds': 0.0}
+
+# whether the full-text search index exists, SQLite may be built without FTS4
+searchIndex = False
+
+# columns added to tables of the original database layout
+_COLUMNS = ( ('recording', 'video_digest', 'TEXT  NULL')
+           , ('recording', 'video_size', 'INTEGER  NULL')
+           , ('recording', 'download_started', 'TIMESTAMP  NULL')
+           , ('recording', 'download_seconds', 'REAL  NULL')
+           , ('recording', 'account', "TEXT  NOT NULL DEFAULT 'default'")
+           , ('pending_delete', 'account', "TEXT  NOT NULL DEFAULT 'default'")
+           , ('recording', 'lease_owner', 'TEXT  NULL')
+           , ('recording', 'lease_expires', 'REAL  NULL')
+           , ('recording', 'duplicate_key', 'TEXT  NULL')
+           , ('recording', 'duplicate_of', 'TEXT  NULL')
+           )
+
+# unique constraints of the recording table, including the account since
+# the original layout made bong_id and downloadHQ unique across all accounts
+_RECORDING_UNIQUE = ( ('account', 'bong_id')
+                    , ('account', 'downloadHQ')
+                    )
+
+# indexes of the original layout, per account
+_RECORDING_INDEXES = ( "CREATE UNIQUE INDEX IF NOT EXISTS [IDX_RECORDING_CHST] ON [recording]([account] ASC, [channel] DESC, [start] DESC)"
+                     , "CREATE UNIQUE INDEX IF NOT EXISTS [IDX_RECORDING_IDHQ] ON [recording]([account] ASC, [bong_id] ASC, [downloadHQ] ASC)"
+                     )
+
+# indexes on added columns, created after the columns
+_INDEXES = ( "CREATE INDEX IF NOT EXISTS [IDX_RECORDING_DUPLICATEKEY] ON [recording]([duplicate_key] ASC)"
+           ,
+           )
+
+# tables added to the original database layout, created on first use
+_SCHEMA = ( """
+            CREATE TABLE IF NOT EXISTS [pending_delete] (
+            [bong_id] TEXT  NOT NULL PRIMARY KEY,
+            [queued] TIMESTAMP  NOT NULL,
+            [attempts] INTEGER  NOT NULL DEFAULT 0
+            )
+            """
+          , """
+            CREATE TABLE IF NOT EXISTS [download_progress] (
+            [targetfile] TEXT  NOT NULL PRIMARY KEY,
+            [url] TEXT  NOT NULL,
+            [expected_length] INTEGER  NULL,
+            [bytes_completed] INTEGER  NOT NULL DEFAULT 0,
+            [validator] TEXT  NULL,
+            [segments] TEXT  NULL,
+            [updated] TIMESTAMP  NOT NULL
+            )
+            """
+          , """
+            CREATE TABLE IF NOT EXISTS [artwork] (
+            [url] TEXT  NOT NULL PRIMARY KEY,
+            [filename] TEXT  NOT NULL,
+            [fetched] TIMESTAMP  NOT NULL
+            )
+            """
+          , """
+            CREATE TABLE IF NOT EXISTS [postprocess] (
+            [bong_id] TEXT  NOT NULL,
+            [step] TEXT  NOT NULL,
+            [status] TEXT  NOT NULL,
+            [video] TEXT  NOT NULL,
+            [queued] TIMESTAMP  NOT NULL,
+            [finished] TIMESTAMP  NULL,
+            [seconds] REAL  NULL,
+            [message] TEXT  NULL,
+            PRIMARY KEY ([bong_id], [step])
+            )
+            """
+          )
+
+
+# full-text search index of BongIndex, reading the text from the recording
+# table, the first tokenizer available is used
+_SEARCH_INDEX = """CREATE VIRTUAL TABLE [recording_fts] USING fts4(content="recording", [title], [subtitle], [description], [channel], [genre], tokenize={})"""
+_SEARCH_TOKENIZERS = ('unicode61', 'simple')
+
+
+def _createSearchIndex(con):
+    """
+    create the search index if it does not exist and index all recordings
+    """
+    row = con.execute("select sql from sqlite_master where name = 'recording_fts'").fetchone()
+    if row is not None:
+        if 'content=' in row[0]:
+            return True
+        # earlier versions kept a copy of the text in the index
+        con.execute("DROP TABLE [recording_fts]")
+    for tokenizer in _SEARCH_TOKENIZERS:
+        try:
+            con.execute(_SEARCH_INDEX.format(tokenizer))
+        except sqlite3.OperationalError, e:
+            error = e
+            continue
+        BongEnvironment.logger.info("building full-text search index")
+        con.execute("INSERT INTO [recording_fts] ([recording_fts]) VALUES ('rebuild')")
+        return True
+    BongEnvironment.logger.warning("full-text search not available ({!s})".format(error))
+    return False
+
+
+def _hasUniqueIndex(con, table, columns):
+    """
+    check if the table has a unique index on exactly the given columns
+    """
+    for row in con.execute("PRAGMA index_list([{}])".format(table)):
+        name, unique = row[1], row[2]
+        if unique:
+            if [c[2] for c in con.execute("PRAGMA index_info([{}])".format(name))] == list(columns):
+                return True
+    return False
+
+
+def _columns(con, table):
+    return [row[1] for row in con.execute("PRAGMA table_info([{}])".format(table))]
+
+
+def _rebuildRecordingTable(con):
+    """
+    copy the recording table into a new one with the unique constraints of _RECORDING_UNIQUE
+
+    SQLite cannot drop the UNIQUE column constraints of the original
+    layout, so the table is rebuilt. Ids are copied, AUTOINCREMENT
+    continues after the highest one.
+    """
+    BongEnvironment.logger.info("rebuilding table recording with unique constraints per account")
+    definitions = []
+    names = []
+    for cid, name, type, notnull, default, pk in con.execute("PRAGMA table_info([recording])").fetchall():
+        names.append("[{}]".format(name))
+        if pk:
+            definitions.append("[{}] INTEGER  NOT NULL PRIMARY KEY AUTOINCREMENT".format(name))
+            continue
+        definition = "[{}] {}".format(name, type)
+        if notnull:
+            definition += "  NOT NULL"
+        if default is not None:
+            definition += " DEFAULT {}".format(default)
+        definitions.append(definition)
+    for columns in _RECORDING_UNIQUE:
+        definitions.append("UNIQUE ({})".format(", ".join("[{}]".format(c) for c in columns)))
+    con.execute("CREATE TABLE [recording_rebuilt] (\n{}\n)".format(",\n".join(definitions)))
+    con.execute("INSERT INTO [recording_rebuilt] ({0}) SELECT {0} FROM [recording]".format(", ".join(names)))
+    # the indexes of the old table are dropped with it
+    con.execute("DROP TABLE [recording]")
+    con.execute("ALTER TABLE [recording_rebuilt] RENAME TO [recording]")
+
+
+def _prepareDatabase(con):
+    """
+    bring an existing database up to the state expected by this version
+    """
+    global searchIndex
+    # WAL needs shared memory, a database shared by several hosts uses the rollback journal
+    requested = BongEnvironment.settings['databaseJournalMode']
+    mode = con.execute("PRAGMA journal_mode={}".format(requested)).fetchone()[0]
+    if mode.lower() != requested:
+        BongEnvironment.logger.warning("database journal mode is {!s}, {!s} not available".format(mode, requested))
+    con.execute("PRAGMA synchronous=NORMAL")
+    # other processes may prepare the database at the same time, the changes
+    # are made in one immediate transaction with implicit transactions disabled
+    isolation_level = con.isolation_level
+    con.isolation_level = None
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in _SCHEMA:
+                con.execute(statement)
+            for table, column, definition in _COLUMNS:
+                if column not in _columns(con, table):
+                    BongEnvironment.logger.info("adding column {!s}.{!s}".format(table, column))
+                    con.execute("ALTER TABLE [{}] ADD COLUMN [{}] {}".format(table, column, definition))
+            if not all(_hasUniqueIndex(con, 'recording', columns) for columns in _RECORDING_UNIQUE):
+                _rebuildRecordingTable(con)
+            for statement in _RECORDING_INDEXES + _INDEXES:
+                con.execute(statement)
+            searchIndex = _createSearchIndex(con)
+            con.execute("COMMIT")
+        except:
+            con.execute("ROLLBACK")
+            raise
+    finally:
+        con.isolation_level = isolation_level
+
+
+def connection():
+    """
+    return the shared database connection, opening it on first use
+    """
+    global _connection
+    with _lock:
+        if _connection is None:
+            BongEnvironment.logger.info("opening database {!s}".format(BongEnvironment.settings['dbfile']))
+            _connection = sqlite3.connect( BongEnvironment.settings['dbfile']
+                                         , timeout=60
+                                         , check_same_thread=False)
+            _prepareDatabase(_connection)
+        return _connection
+
+
+@contextlib.contextmanager
+def transaction():
+    """
+    run a block of statements as one transaction on the shared connection
+
+    The transaction is committed if the block completes and rolled back
+    if it raises an exception.
+    """
+    started = time.time()
+    with _lock:
+        con = connection()
+        try:
+            yield con
+            con.commit()
+        except:
+            con.rollback()
+            raise
+        finally:
+            statistics['transactions'] += 1
+            statistics['seconds'] += time.time() - started
+            BongMetrics.sqliteSeconds.observe(time.time() - started)
+
+
+def close():
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
@@ -0,0 +1,150 @@
+"""
+Background deletion of downloaded recordings from Bong Space
+
+After a successful download the recording is queued for deletion
+instead of being deleted on the download worker's critical path. A
+background thread collects the queued deletes into batches. The bong.tv
+API deletes one recording per request, so the requests of a batch are
+sent one after the other on a keep-alive connection. A batch shares the
+database writes and the retries of failed requests. Every queued delete
+is recorded in the pending_delete table of the recordings database until
+bong.tv has confirmed it, so deletes interrupted by a crash are sent by
+the next run.
+
+A delete refused by bong.tv, with status false or a 4xx status, is not
+retried. Neither is a delete which failed in deleteMaximumAttempts
+attempts over all runs. Both are dropped from pending_delete with a
+warning.
+"""
+import time
+import socket
+import httplib
+import threading
+import Queue
+import BongEnvironment
+import BongDatabase
+import BongMetrics
+
+
+RETRIES = 3
+
+
+class DeleteQueue(threading.Thread):
+
+    def __init__(self, bong, batchSize=10):
+        threading.Thread.__init__(self, name="BongDelete")
+        self.daemon = True
+        self.bong = bong
+        self.batchSize = max(1, batchSize)
+        self.queue = Queue.Queue()
+        self.deleted = 0
+        self.deletedIds = set()
+        self.failed = 0
+        self.dropped = 0
+        BongMetrics.queueDepth.setFunction(self.queue.qsize, queue='delete', account=bong.account)
+
+    def resume(self):
+        """
+        queue the deletes left pending by previous runs
+        """
+        with BongDatabase.transaction() as con:
+            pending = [row[0] for row in con.execute( "select bong_id from pending_delete where account = ? order by queued"
+                                                    , (self.bong.account,))]
+        if pending:
+            BongEnvironment.logger.info("resuming {!s} pending deletes".format(len(pending)))
+        for bong_id in pending:
+            self.queue.put(bong_id)
+
+    def put(self, bong_id):
+        """
+        record a delete in the database and queue it for the background thread
+        """
+        with BongDatabase.transaction() as con:
+            con.execute( "insert or ignore into pending_delete (bong_id, account, queued, attempts) values (:bong_id, :account, datetime('now'), 0)"
+                       , {"bong_id": bong_id, "account": self.bong.account})
+        self.queue.put(bong_id)
+
+    def stop(self):
+        """
+        send all queued deletes and wait for the background thread to finish
+        """
+        self.queue.put(None)
+        self.join()
+        BongEnvironment.logger.info( "account {!s}: {!s} recordings deleted, {!s} deletes left pending, {!s} dropped"
+                                     .format(self.bong.account, self.deleted, self.failed, self.dropped))
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            bong_id = self.queue.get()
+            while bong_id is not None:
+                if bong_id not in batch:
+                    batch.append(bong_id)
+                if len(batch) >= self.batchSize:
+                    break
+                try:
+                    bong_id = self.queue.get(timeout=1)
+                except Queue.Empty:
+                    break
+            stopping = bong_id is None
+            if batch:
+                try:
+                    self._sendBatch(batch)
+                except Exception:
+                    BongEnvironment.logger.exception("sending deletes failed")
+
+    def _deleteOne(self, bong_id):
+        """
+        send one delete, return True if done, False if refused and None if it may succeed later
+        """
+        try:
+            return self.bong.deleteRecording(bong_id)
+        except (socket.error, httplib.HTTPException), e:
+            BongEnvironment.logger.warning("deleting recording {!s} failed ({!s})".format(bong_id, e))
+            return None
+
+    def _sendBatch(self, batch):
+        """
+        delete a batch of recordings, retrying failed deletes with increasing delay
+        """
+        account = self.bong.account
+        maximum = BongEnvironment.settings['deleteMaximumAttempts']
+        for attempt in xrange(RETRIES):
+            if attempt:
+                BongMetrics.retries.inc(len(batch), operation='delete')
+                time.sleep(2 ** attempt)
+            done = []
+            refused = []
+            remaining = []
+            for bong_id in batch:
+                result = self._deleteOne(bong_id)
+                if result:
+                    done.append(bong_id)
+                elif result is None:
+                    remaining.append(bong_id)
+                else:
+                    refused.append(bong_id)
+            with BongDatabase.transaction() as con:
+                con.executemany( "delete from pending_delete where account = ? and bong_id = ?"
+                               , [(account, i) for i in done + refused])
+                con.executemany( "update pending_delete set attempts = attempts + 1 where account = ? and bong_id = ?"
+                               , [(account, i) for i in remaining])
+                # deletes failing in every run are given up eventually
+                exhausted = [row[0] for row in con.execute( "select bong_id from pending_delete where account = ? and attempts >= ?"
+                                                          , (account, maximum))
+                                    if row[0] in remaining]
+                con.executemany( "delete from pending_delete where account = ? and bong_id = ?"
+                               , [(account, i) for i in exhausted])
+            for bong_id in refused:
+                BongEnvironment.logger.warning("delete of recording {!s} refused by bong.tv, not retried".format(bong_id))
+            for bong_id in exhausted:
+                BongEnvironment.logger.warning("delete of recording {!s} failed {!s} times, given up".format(bong_id, maximum))
+            self.deleted += len(done)
+            self.deletedIds.update(done)
+            self.dropped += len(refused) + len(exhausted)
+            batch = [i for i in remaining if i not in exhausted]
+            if not batch:
+                return
+        BongEnvironment.logger.warning("deletes of recordings {!s} left pending for the next run".format(", ".join(batch)))
+        self.failed += len(batch)
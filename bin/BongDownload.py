@@ -4,29 +4,127 @@ BongDownload
 
 """
 import sys
-import sqlite3
 import time
+import socket
+import hashlib
 import os
 import os.path
+import threading
+import Queue
 import BongEnvironment
 import BongAPI
+import BongDatabase
+import BongDeleteQueue
 import BongLibrary
-from urlgrabber.grabber import URLGrabber, URLGrabError
+import BongSegments
+import BongProgress
+import BongBandwidth
+import BongScheduler
+import BongStorage
+import BongLease
+import BongFastPath
+import BongArtwork
+import BongPostProcess
+import BongDuplicates
+import BongMetrics
+from BongLogging import LazyMessage
+import BongStream
+import BongHttp
+try:
+    from urlgrabber.grabber import URLGrabber, URLGrabError
+except ImportError:
+    # urlgrabber is only needed by the download engine of the same name
+    URLGrabber = None
+
+
+class DownloadResult:
+    """
+    digest, size and timing of a completed download
+    """
+    def __init__(self, digest, size, started, seconds, throttled):
+        self.digest = digest
+        self.size = size
+        self.started = started
+        self.seconds = seconds
+        self.throttled = throttled
+
+
+def _grabStream(grabber, url, targetfile, progress, meter, retries=BongHttp.RETRIES):
+    """
+    download url into targetfile as a single stream, hashing the data as it is written
+
+    A partial target file is continued with a range request. Returns the
+    digest of the file, or None if the download failed
+    """
+    h = hashlib.sha256()
+    position = 0
+    if os.path.isfile(targetfile):
+        position = os.path.getsize(targetfile)
+        if progress.length is not None and position > progress.length:
+            os.remove(targetfile)
+            position = 0
+        BongSegments.hashFileRange(targetfile, 0, position, h)
+    for attempt in xrange(retries):
+        if progress.length is not None and position == progress.length:
+            return "sha256:" + h.hexdigest()
+        try:
+            if 0 < position:
+                fo = grabber.urlopen(url, range=(position, None))
+            else:
+                fo = grabber.urlopen(url)
+            try:
+                with open(targetfile, 'ab') as f:
+                    while True:
+                        data = fo.read(BongSegments.CHUNK_SIZE)
+                        if not data:
+                            break
+                        meter.consume(len(data))
+                        f.write(data)
+                        h.update(data)
+                        position += len(data)
+                        BongProgress.advance(progress, position, f)
+            finally:
+                fo.close()
+            if progress.length is None or position == progress.length:
+                return "sha256:" + h.hexdigest()
+            BongEnvironment.logger.warning("download of {!s} ended after {!s} of {!s} bytes".format(url, position, progress.length))
+        except (URLGrabError, IOError, socket.error), e:
+            BongEnvironment.logger.warning('exception {!s} trying to download {!s} to {!s}, attempt {!s}'.format(e, url, targetfile, attempt + 1))
+            BongMetrics.retries.inc(operation='stream')
+        progress.bytesCompleted = position
+        BongProgress.save(progress)
+    return None
+
+
+def _streamFile(url, targetfile, progress, meter):
+    """
+    download url as a single stream with the configured download engine
+    """
+    if BongEnvironment.settings['downloadEngine'] == 'urlgrabber':
+        if URLGrabber is not None:
+            grabber = URLGrabber( progress_obj=None
+                                , throttle=0
+                                , retry=BongHttp.RETRIES
+                                , retrycodes=[-1,4,5,6,7,12,14]
+                                , timeout=BongHttp.TIMEOUT
+                                , user_agent=BongHttp.USER_AGENT
+                                )
+            return _grabStream(grabber, url, targetfile, progress, meter)
+        BongEnvironment.logger.warning("urlgrabber is not installed, using the builtin download engine")
+    return BongStream.download(url, targetfile, progress, meter)
 
 
 def downloadFile(url, filename, subdir):
-    BongEnvironment.logger.info("starting download of {!s} to {!s}/{!s}".format(url, subdir, filename))
-    maxBytesPerSecond=0        #  2**19   ==> 0.5 MByte/s 
-                               #  0       ==> not restricted
-    grabber = URLGrabber( progress_obj=None
-                        , throttle=maxBytesPerSecond        
-                        , reget='simple'
-                        , retry=5
-                        , retrycodes=[-1,4,5,6,7,12,14]
-                        , timeout=30
-                        , user_agent='bong download manager/1.0'
-                        )
-    
+    """
+    download url to filename in the recording directory subdir
+
+    Returns a DownloadResult, or None if the download failed. Raises
+    BongStorage.InsufficientSpace if the file does not fit into the
+    recordings volume.
+    """
+    BongEnvironment.logger.info(LazyMessage("starting download of {!s} to {!s}/{!s}", url, subdir, filename))
+    # bandwidth is limited by the governor shared by all transfers
+    meter = BongBandwidth.Meter(BongBandwidth.governor())
     statinfo = os.stat(BongEnvironment.settings['recdir'])
     
     targetdir = os.path.join(BongEnvironment.settings['recdir'], subdir)
@@ -37,62 +135,370 @@ def downloadFile(url, filename, subdir):
             os.chown(targetdir, statinfo.st_uid, statinfo.st_gid)
 
     targetfile = os.path.join(targetdir, filename)
+    # data is written to a temporary name, renamed when the download is complete
+    partfile = targetfile + '.part'
     
-    t1 = time.time()
-    try:
-        local_filename = grabber.urlgrab(url, targetfile)
-    except URLGrabError, e:
-        BongEnvironment.logger.warning('exception {!s} trying to download {!s} to {!s}'.format(e, url, targetfile))
-        return False
-    t2 = time.time()
-
-    if local_filename != targetfile:
-        BongEnvironment.logger.warning("local_filename {!r} <> targetfile {!r}".format(local_filename, targetfile))
-        return False
-        
-    if not os.path.isfile(targetfile):
-        BongEnvironment.logger.warning("file {!r} not found".format(targetfile))
-        return False
+    # compare the resource with the record of an interrupted earlier attempt
+    info = BongSegments.probe(url, BongSegments.PROBE_ATTEMPTS)
+    progress = BongProgress.load(partfile)
+    if progress is None and os.path.isfile(targetfile):
+        # partial file of a version writing to the final name
+        progress = BongProgress.load(targetfile)
+        if progress is not None:
+            BongProgress.remove(targetfile)
+            os.rename(targetfile, partfile)
+            progress.targetfile = partfile
+    if progress is not None:
+        if not os.path.isfile(partfile):
+            progress = None
+        elif info is not None and not progress.matches(url, info.length, info.validator):
+            BongEnvironment.logger.info("resource {!s} has changed, discarding partial file {!s}".format(url, partfile))
+            os.remove(partfile)
+            progress = None
+        else:
+            if progress.segments is None:
+                # a single stream continues at the end of the partial file
+                progress.bytesCompleted = os.path.getsize(partfile)
+            elif info is None:
+                # a failed HEAD request is no reason to give up the segments fetched so far
+                BongEnvironment.logger.info("continuing {!s} with the stored segment map".format(url))
+                info = BongSegments.ResourceInfo(progress.length, True, progress.validator)
+            BongEnvironment.logger.info("resuming download of {!s} at {!s} bytes".format(url, progress.bytesCompleted))
+        if progress is None:
+            BongProgress.remove(partfile)
+
+    segments = BongEnvironment.settings['downloadSegments']
+    if progress is not None and progress.segments is not None:
+        # a stored segment map is continued whatever the current settings
+        segmented = True
     else:
-        if os.name == 'posix':
-            os.chmod(targetfile, 0666)
-            os.chown(targetfile, statinfo.st_uid, statinfo.st_gid)
+        if 1 < segments and info is not None and not info.ranges:
+            BongEnvironment.logger.info("server does not support range requests, using a single stream")
+        segmented = 1 < segments and info is not None and info.ranges and 2 * BongSegments.MINIMUM_SEGMENT_SIZE <= info.length
+    if segmented and (progress is None or progress.segments is None):
+        progress = BongProgress.Progress(partfile, url, info.length, info.validator, 0, BongSegments.splitRanges(info.length, segments))
+        if os.path.isfile(partfile):
+            os.remove(partfile)
+    elif not segmented and (progress is None or progress.segments is not None):
+        progress = BongProgress.Progress( partfile, url
+                                        , info.length if info else None
+                                        , info.validator if info else None)
+        if os.path.isfile(partfile):
+            os.remove(partfile)
+
+    # admit the download only if the rest of it fits into the recordings volume
+    reserved = 0
+    if info is not None and info.length:
+        present = os.path.getsize(partfile) if os.path.isfile(partfile) else 0
+        reserved = BongStorage.admission.reserve(targetdir, max(0, info.length - present))
+        try:
+            with open(partfile, 'ab') as f:
+                allocated = BongStorage.preallocate(f, info.length, keepSize=not segmented)
+        except Exception:
+            BongStorage.admission.release(reserved)
+            raise
+        if allocated:
+            # the file holds its space now, without preallocation the reservation is kept until the transfer ends
+            BongStorage.admission.release(reserved)
+            reserved = 0
+    try:
+        BongProgress.save(progress)
+
+        started = time.time()
+        if segmented:
+            digest = BongSegments.downloadSegmented(url, partfile, info, segments, meter, progress)
+            if digest is None:
+                return None
+        else:
+            digest = _streamFile(url, partfile, progress, meter)
+            if digest is None:
+                return None
+            BongProgress.remove(partfile)
+        seconds = time.time() - started
+    finally:
+        BongStorage.admission.release(reserved)
+
+    if not os.path.isfile(partfile):
+        BongEnvironment.logger.warning("file {!r} not found".format(partfile))
+        return None
+    BongStorage.finalize(partfile, targetfile)
+    if os.name == 'posix':
+        os.chmod(targetfile, 0666)
+        os.chown(targetfile, statinfo.st_uid, statinfo.st_gid)
     
-    sz = os.path.getsize(local_filename)
+    sz = os.path.getsize(targetfile)
     
-    BongEnvironment.logger.info("Download completed. Speed = {!s} byte/second, File size = {!s} bytes, Duration = {!s} seconds".format(float(sz)/float(t2-t1), sz, t2-t1))
+    BongEnvironment.logger.info(LazyMessage("Download completed. Speed = {!s} byte/second, File size = {!s} bytes, Duration = {!s} seconds, Throttled = {!s} seconds, Digest = {!s}", float(sz)/float(seconds), sz, seconds, meter.throttled, digest))
 
-    return True
+    BongMetrics.transferBytes.inc(sz)
+    BongMetrics.transferSeconds.observe(seconds)
+    BongMetrics.transferThrottled.inc(meter.throttled)
+    if 0 < seconds:
+        BongMetrics.transferSpeed.set(sz / seconds)
 
+    return DownloadResult(digest, sz, started, seconds, meter.throttled)
 
-def work():
+
+def downloadRecording(bong, deletes, id, kv):
+    """
+    download video and image of a single recording, register the
+    download in the database and queue the recording for deletion
+    from Bong Space
+    """
+    subdir = "bong{0:06d}".format(kv['db_id'])
+    if kv['downloadHQ']:
+        try:
+            result = downloadFile(kv['downloadHQ'], BongLibrary.renameResource(kv['downloadHQ'], 'video_hq'), subdir)
+        except BongStorage.InsufficientSpace, e:
+            # the recording stays available and is tried again by a later run
+            BongEnvironment.logger.warning("download of recording {!s} deferred ({!s})".format(id, e))
+            BongMetrics.transferDeferred.inc()
+            return
+        if result:
+            if kv['image'] and kv['image_name']:
+                # the image has been prefetched into the artwork cache
+                targetfile = os.path.join( BongEnvironment.settings['recdir'], subdir
+                                         , BongLibrary.renameResource(kv['image'], 'image'))
+                if not BongArtwork.pipeline().install(kv['image'], targetfile):
+                    BongMetrics.transferFailures.inc(kind='image')
+            bong.registerDownload(id, result)
+            deletes.put(id)
+            BongDuplicates.downloaded(bong, deletes, id)
+            stage = BongPostProcess.stage()
+            if stage is not None:
+                stage.submit(id, os.path.join( BongEnvironment.settings['recdir'], subdir
+                                             , BongLibrary.renameResource(kv['downloadHQ'], 'video_hq')))
+        else:
+            BongMetrics.transferFailures.inc(kind='video')
+
+
+# limits the downloads running at the same time across all accounts
+_downloadSlots = threading.BoundedSemaphore(1)
+
+
+def _downloadWorker(bong, deletes, jobs):
+    """
+    take recordings from the job queue until it is empty
     
-    bong = BongAPI.BongApi()
+    Any failure is logged and confined to the recording being processed,
+    the worker continues with the next recording in the queue
+    """
+    while True:
+        try:
+            prio, sequence, id, kv = jobs.get_nowait()
+        except Queue.Empty:
+            return
+        try:
+            if BongLease.keeper.claim(bong.account, id):
+                try:
+                    with _downloadSlots:
+                        downloadRecording(bong, deletes, id, kv)
+                finally:
+                    BongLease.keeper.release(bong.account, id)
+            else:
+                BongEnvironment.logger.info("recording {!s} is leased by another process".format(id))
+        except Exception:
+            BongEnvironment.logger.exception("download of recording {!s} failed".format(id))
+        finally:
+            jobs.task_done()
+
+
+def downloadRecordings(bong, deletes, recordings):
+    """
+    download all given recordings in order of priority using a pool of worker threads
+    """
+    jobs = BongScheduler.schedule(recordings)
+    BongMetrics.queueDepth.setFunction(jobs.qsize, queue='download', account=bong.account)
+
+    workers = []
+    for i in xrange(min(BongEnvironment.settings['downloadWorkers'], jobs.qsize())):
+        t = threading.Thread(target=_downloadWorker, args=(bong, deletes, jobs), name="BongDownload-{!s}".format(i))
+        t.daemon = True
+        t.start()
+        workers.append(t)
+
+    for t in workers:
+        t.join()
+
+
+def processRecordings(bong, deletes):
+    """
+    download recordings until the list of available recordings is exhausted
+    
+    Returns the number of recordings handed to the download workers
+    """
+    count = 0
+
+    # prevIDs hold the list recording ids previously processed
+    # newIDs holds the list of recording ids to be processed
+    # if we get the same list of ids as before, we are risking an endless while loop
+    prevIDs = bong.getSetOfIds()
+    
+    while bong.refreshDatabase():
+        newIDs = bong.getSetOfIds()
+        if newIDs != prevIDs:
+            prevIDs = newIDs.copy()
+            count += len(newIDs)
+            BongArtwork.pipeline().prefetch(bong.recordings.items())
+            downloadRecordings(bong, deletes, BongDuplicates.select(bong, deletes, bong.recordings.items()))
+        else:
+            BongEnvironment.logger.warning("Breaking out of an infinite loop trying to process the same recordings repeatedly")
+            break
+
+    BongArtwork.pipeline().evict()
+    return count
+
+
+def _runAccount(account):
+    """
+    process the recordings of one account with its own API session and delete queue
+    """
+    bong = BongAPI.BongApi(account)
     
     if bong.checkCredentials():
         
-        # prevIDs hold the list recording ids previously processed
-        # newIDs holds the list of recording ids to be processed
-        # if we get the same list of ids as before, we are risking an endless while loop
-        prevIDs = bong.getSetOfIds()
+        deletes = BongDeleteQueue.DeleteQueue(bong, BongEnvironment.settings['deleteBatchSize'])
+        deletes.resume()
+        deletes.start()
+
+        processRecordings(bong, deletes)
+
+        deletes.stop()
+        _recordState(bong, deletes)
+    else:
+        BongEnvironment.logger.warning("Username and password of account {!s} not valid".format(bong.account))    
+
+    bong.http.logStatistics()
+    bong.cache.logStatistics()
+    bong.http.close()
+
+
+def _recordState(bong, deletes):
+    """
+    remember the list of recordings for the fast path of the next run
+    """
+    if bong.listIds is None:
+        return
+    with BongDatabase.transaction() as con:
+        left = con.execute( "select count(*) from recording where account = ? and is_downloadable = 'Y' and download_state = 1"
+                          , (bong.account,)).fetchone()[0]
+        left += con.execute("select count(*) from pending_delete where account = ?", (bong.account,)).fetchone()[0]
+    # recordings which could not be stored are left over as well
+    BongFastPath.record(bong.account, bong.etag, bong.lastModified, bong.listIds - deletes.deletedIds, left == 0 and not bong.conflicts)
+
+
+def _pollAccount(account, stopping):
+    """
+    poll bong.tv for new recordings of one account until the stopping event is set
+    
+    The polling interval starts at pollMinimumInterval seconds and is
+    doubled after every poll without new recordings up to
+    pollMaximumInterval. New recordings reset it to the minimum. The list
+    is requested conditionally, except when the maximum interval has been
+    reached, so recordings which failed earlier are retried regularly.
+    """
+    minimum = BongEnvironment.settings['pollMinimumInterval']
+    maximum = max(minimum, BongEnvironment.settings['pollMaximumInterval'])
+
+    bong = BongAPI.BongApi(account)
+    bong.conditionalRequests = True
+    
+    if bong.checkCredentials():
         
-        while bong.refreshDatabase():
-            newIDs = bong.getSetOfIds()
-            if newIDs != prevIDs:
-                prevIDs = newIDs.copy()
-                
-                for id, kv in bong.recordings.items(): 
-                    subdir = "bong{0:06d}".format(kv['db_id'])
-                    if kv['downloadHQ']:
-                        if downloadFile(kv['downloadHQ'], BongLibrary.renameResource(kv['downloadHQ'], 'video_hq'), subdir):
-                            if kv['image'] and kv['image_name']:
-                                downloadFile(kv['image'], BongLibrary.renameResource(kv['image'], 'image'), subdir)
-                            bong.registerDownload(id)
-                            bong.deleteRecording(id)
+        deletes = BongDeleteQueue.DeleteQueue(bong, BongEnvironment.settings['deleteBatchSize'])
+        deletes.resume()
+        deletes.start()
+
+        interval = minimum
+        while not stopping.is_set():
+            if interval >= maximum:
+                bong.resetValidators()
+            # the recordings left from the last poll would stop processRecordings() as seen before
+            bong.recordings.clear()
+            try:
+                found = processRecordings(bong, deletes)
+            except Exception:
+                BongEnvironment.logger.exception("polling for recordings of account {!s} failed".format(bong.account))
+                found = 0
+            if found:
+                interval = minimum
             else:
-                BongEnvironment.logger.warning("Breaking out of an infinite loop trying to process the same recordings repeatedly")
-                break
+                interval = min(2 * interval, maximum)
+            BongEnvironment.logger.info("account {!s}: {!s} recordings processed, next poll in {!s} seconds".format(bong.account, found, interval))
+            BongMetrics.writeTextFile()
+            stopping.wait(interval)
+
+        deletes.stop()
     else:
-        BongEnvironment.logger.warning("Username and password not valid")    
+        BongEnvironment.logger.warning("Username and password of account {!s} not valid".format(bong.account))    
+
+    bong.http.logStatistics()
+    bong.cache.logStatistics()
+    bong.http.close()
+
+
+def _forEachAccount(function, *args):
+    """
+    run function for every configured account, each account in its own thread
+
+    All accounts share the download slots, so at most downloadWorkers
+    recordings are downloaded at the same time, and the bandwidth governor.
+    """
+    global _downloadSlots
+    _downloadSlots = threading.BoundedSemaphore(BongEnvironment.settings['downloadWorkers'])
+
+    accounts = BongEnvironment.settings['accounts']
+    if len(accounts) == 1:
+        function(accounts[0], *args)
+        return
+
+    def run(account):
+        try:
+            function(account, *args)
+        except Exception:
+            BongEnvironment.logger.exception("processing account {!s} failed".format(account['name']))
+
+    threads = []
+    for account in accounts:
+        t = threading.Thread(target=run, args=(account,), name="BongAccount-{!s}".format(account['name']))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        # join with a timeout, so signals reach the main thread of a daemon
+        while t.is_alive():
+            t.join(1)
+
+
+def work():
+    
+    # worker processes are started before the download threads
+    BongPostProcess.stage()
+    BongLease.releaseOrphaned()
+
+    _forEachAccount(_runAccount)
+
+    BongArtwork.pipeline().logStatistics()
+    BongPostProcess.stop()
+    BongLease.keeper.stop()
+    BongDatabase.close()
+    BongMetrics.writeTextFile()
+
+
+def daemon(stopping):
+    """
+    poll bong.tv for new recordings of all accounts until the stopping event is set
+    """
+    if BongEnvironment.settings['metricsPort']:
+        BongMetrics.serve(BongEnvironment.settings['metricsPort'])
+
+    BongPostProcess.stage()
+    BongLease.releaseOrphaned()
 
+    _forEachAccount(_pollAccount, stopping)
 
+    BongArtwork.pipeline().logStatistics()
+    BongPostProcess.stop()
+    BongLease.keeper.stop()
+    BongDatabase.close()
+    BongMetrics.writeTextFile()
@@ -4,22 +4,66 @@ Bong.tv Download Manager
 
 Checks bong.tv online-VCR for recorded shows, moves video files and metadata 
 to local storage and deletes recording from Bong Space after successful download
+
+Started with --daemon the download manager keeps running and polls
+bong.tv for new recordings until it receives SIGTERM or SIGINT.
+
+Several download managers may run at the same time, on one host or on
+several hosts sharing the recordings database, since each recording is
+leased to one of them. With singleInstance = true only one process per
+host is allowed.
+
+A run started without --daemon ends right away if the list of
+recordings is unchanged since the last run and nothing was left to do.
+The download and database modules are only imported when there is work.
 """
+import time
+_started = time.time()
+
+import signal
+import argparse
+import threading
 import BongSingleton
 import BongEnvironment
-import BongDownload
+import BongFastPath
+import BongMetrics
 
 def main():
-    BongSingleton.terminateScriptIfAlreadyRunning()
+    parser = argparse.ArgumentParser(description="Bong.tv Download Manager")
+    parser.add_argument('--daemon', action='store_true', help="keep running and poll for new recordings")
+    args = parser.parse_args()
+
     BongEnvironment.initializeEnvironment(__file__)
+    if BongEnvironment.settings['singleInstance']:
+        BongSingleton.terminateScriptIfAlreadyRunning()
     
     BongEnvironment.LogScriptStart()
     
-    BongDownload.work()
+    if not args.daemon and BongFastPath.unchanged():
+        seconds = time.time() - _started
+        BongEnvironment.logger.info("list of recordings unchanged and nothing left to do, run took {:.3f} seconds".format(seconds))
+        BongMetrics.runSeconds.set(seconds, result='unchanged')
+        BongMetrics.writeTextFile()
+        BongEnvironment.LogScriptTermination()
+        return
+
+    import BongDownload
+    if args.daemon:
+        stopping = threading.Event()
+        def stop(signum, frame):
+            BongEnvironment.logger.info("signal {!s} received, stopping daemon".format(signum))
+            stopping.set()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        BongDownload.daemon(stopping)
+    else:
+        BongDownload.work()
+        seconds = time.time() - _started
+        BongEnvironment.logger.info("run took {:.3f} seconds".format(seconds))
+        BongMetrics.runSeconds.set(seconds, result='processed')
+        BongMetrics.writeTextFile()
     
     BongEnvironment.LogScriptTermination()
     
 if __name__ == "__main__":
     main()
-
-
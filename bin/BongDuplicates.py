@@ -0,0 +1,186 @@
+"""
+Detection of duplicate recordings before they are downloaded
+
+bong.tv often records the same episode more than once, as a repeat or on
+another channel. Every recording gets a duplicate key made from its
+normalized title, subtitle, series season and series number, which is
+stored in the indexed duplicate_key column of the recording table when
+the recording is first considered for download.
+Recordings without subtitle and series information get an empty key and
+are never treated as duplicates.
+
+Before recordings are scheduled, those sharing a key with each other or
+with a downloaded recording are resolved by the configured policy:
+
+    first       keep the recording broadcast first
+    hq          keep the largest HQ video, sizes taken from HEAD requests
+    longer      keep the longest recording, then the first
+    off         download every recording
+
+Duplicates of a downloaded recording are skipped, that is marked with
+download state 2 and the bong id of the recording kept. Only a duplicate
+with a longer or, under the hq policy, larger video than the downloaded
+one is downloaded as well. Duplicates among recordings not downloaded
+yet are skipped the same way, or deferred, which leaves them to a later
+run to decide once the kept recording has been downloaded.
+
+Skipped recordings are deleted from bong.tv if configured, but only
+once the recording kept has been downloaded, so a failed download does
+not lose both.
+"""
+import re
+import unicodedata
+import BongEnvironment
+import BongDatabase
+import BongScheduler
+import BongMetrics
+
+
+# download_state of recordings skipped as duplicates
+SKIPPED = 2
+
+_PUNCTUATION_PATTERN = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def _normalize(value):
+    if value is None:
+        return u''
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    # fold accents, case and punctuation: "Tatort: Der Fall" == "tatort - der fall"
+    value = u''.join(c for c in unicodedata.normalize('NFKD', value) if not unicodedata.combining(c))
+    return _PUNCTUATION_PATTERN.sub(u' ', value.lower()).strip()
+
+
+def duplicateKey(title, subtitle, season, number):
+    """
+    return the duplicate key of a recording, or an empty string if it cannot be identified
+    """
+    subtitle = _normalize(subtitle)
+    season = _normalize(season)
+    number = _normalize(number)
+    if not (subtitle or number):
+        return u''
+    return u"|".join((_normalize(title), subtitle, season, number))
+
+
+def _backfill(con):
+    """
+    compute the keys of recordings which have none yet
+    """
+    rows = con.execute( "select id, title, subtitle, series_season, series_number from recording where duplicate_key is null"
+                      ).fetchall()
+    if rows:
+        BongEnvironment.logger.info("computing duplicate keys of {!s} recordings".format(len(rows)))
+        con.executemany( "update recording set duplicate_key = ? where id = ?"
+                       , [(duplicateKey(*row[1:]), row[0]) for row in rows])
+
+
+def _seconds(duration):
+    # duration = '01:50:00' --> 6600
+    try:
+        hours, minutes, seconds = duration.split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    except (AttributeError, ValueError):
+        return 0
+
+
+def _rank(policy, candidate):
+    """
+    sort key of a candidate (bong_id, start, seconds, size), the preferred one sorts first
+    """
+    bong_id, start, seconds, size = candidate
+    if policy == 'hq':
+        return (-size, start, bong_id)
+    if policy == 'longer':
+        return (-seconds, start, bong_id)
+    return (start, bong_id)
+
+
+def _better(policy, candidate, downloaded):
+    """
+    check if a candidate is preferred to all downloaded recordings (bong_id, seconds, size)
+    """
+    if policy == 'hq':
+        return candidate[3] > max(d[2] for d in downloaded)
+    if policy == 'longer':
+        return candidate[2] > max(d[1] for d in downloaded)
+    return False
+
+
+def select(bong, deletes, recordings):
+    """
+    resolve duplicates among the given (id, kv) pairs, return the pairs to download
+    """
+    settings = BongEnvironment.settings
+    policy = settings['duplicatePolicy']
+    if policy == 'off' or not recordings:
+        return recordings
+    keys = {}
+    with BongDatabase.transaction() as con:
+        _backfill(con)
+        for id, kv in recordings:
+            row = con.execute( "select duplicate_key, start, duration from recording where account = ? and bong_id = ?"
+                             , (bong.account, id)).fetchone()
+            if row is not None and row[0]:
+                keys[id] = row
+
+    # only recordings with a duplicate key need their video sizes
+    if policy == 'hq':
+        BongScheduler.probeSizes([(id, kv) for id, kv in recordings if id in keys], settings['downloadWorkers'])
+
+    groups = {}
+    for id, kv in recordings:
+        if id in keys:
+            key, start, duration = keys[id]
+            groups.setdefault(key, []).append((id, start, _seconds(duration), kv.get('size') or 0))
+
+    skipped = []
+    deferred = set()
+    with BongDatabase.transaction() as con:
+        for key, candidates in groups.iteritems():
+            candidates.sort(key=lambda c: _rank(policy, c))
+            # recordings downloaded before, of this or any other account
+            present = [ (bong_id, _seconds(duration), size or 0) for bong_id, duration, size
+                        in con.execute( "select bong_id, duration, video_size from recording where duplicate_key = ? and download_state = 0"
+                                      , (key,)) ]
+            if present and not _better(policy, candidates[0], present):
+                # the kept recording is there already, nothing is left to wait for
+                keep = present[0][0]
+                skipped.extend((c[0], keep, True) for c in candidates)
+                continue
+            keep = candidates[0][0]
+            if settings['duplicateAction'] == 'skip':
+                skipped.extend((c[0], keep, False) for c in candidates[1:])
+            else:
+                for c in candidates[1:]:
+                    deferred.add(c[0])
+                    BongEnvironment.logger.info("recording {!s} deferred as duplicate of {!s}".format(c[0], keep))
+
+        con.executemany( "update recording set download_state = ?, duplicate_of = ? where account = ? and bong_id = ?"
+                       , [(SKIPPED, keep, bong.account, id) for id, keep, kept in skipped])
+
+    for id, keep, kept in skipped:
+        BongEnvironment.logger.info("recording {!s} skipped as duplicate of {!s}".format(id, keep))
+        BongMetrics.duplicates.inc(action='skipped')
+        # otherwise deleted by downloaded() once the kept recording is there
+        if kept and settings['duplicateDelete']:
+            deletes.put(id)
+    if deferred:
+        BongMetrics.duplicates.inc(len(deferred), action='deferred')
+
+    excluded = deferred.union(id for id, keep, kept in skipped)
+    return [(id, kv) for id, kv in recordings if id not in excluded]
+
+
+def downloaded(bong, deletes, bong_id):
+    """
+    delete the duplicates skipped in favour of a recording which has just been downloaded
+    """
+    if BongEnvironment.settings['duplicatePolicy'] == 'off' or not BongEnvironment.settings['duplicateDelete']:
+        return
+    with BongDatabase.transaction() as con:
+        skipped = [row[0] for row in con.execute( "select bong_id from recording where account = ? and duplicate_of = ? and download_state = ?"
+                                                , (bong.account, bong_id, SKIPPED))]
+    for id in skipped:
+        deletes.put(id)
@@ -5,10 +5,11 @@ Initialize and check settings and resources for the Bong Download Manager
 """
 import sys
 import re
-import logging
-import logging.handlers
 import os.path
 import ConfigParser
+import BongLogging
+import BongBandwidth
+import BongScheduler
 from BongLibrary import alignMultipleTextLines
 
 
@@ -22,34 +23,42 @@ def _dumpSettings():
         logger.info("{} = {!s}".format(k, settings[k]))
 
 
-def ConfigureLogging(logfile, verbose):
+def _getIntOption(config, section, option, default, digits=3):
+    """
+    read an optional non-negative integer from the configuration file
+    
+    Missing or malformed values are replaced by the given default
+    """
+    if not config.has_option(section, option):
+        return default
+    value = config.get(section, option).strip()
+    pattern = re.compile("^[0-9]{1,%d}$" % digits)
+    if pattern.match(value):
+        return int(value)
+    else:
+        return default
+
+
+def _getWeights(config, section):
+    """
+    read a section of name = weight pairs, names are compared in lower case
+    """
+    weights = {}
+    if config.has_section(section):
+        for name in config.options(section):
+            try:
+                weights[name.lower()] = float(config.get(section, name))
+            except ValueError:
+                pass
+    return weights
+
+
+def ConfigureLogging(logfile, verbosity, asynchronous=True):
 
     global logger
     
-    # Set up a specific logger with our desired output level
-    logger = logging.getLogger('Bong')
-    logger.setLevel(logging.DEBUG)
-
-    # create rotating file handler capturing all messages
-    filehandler = logging.handlers.RotatingFileHandler(logfile, maxBytes=10000000, backupCount=3, encoding='utf-8')
-    if verbose:
-        filehandler.setLevel(logging.DEBUG)
-    else:
-        filehandler.setLevel(logging.INFO)
-    # create formatter and add it to the handlers
-    fileformatter = logging.Formatter('%(asctime)s - %(levelname)8s - %(message)s')
-    filehandler.setFormatter(fileformatter)
-    # add the handler to logger
-    logger.addHandler(filehandler)
-
-    # create console handler displaying critical messages
-    streamhandler = logging.StreamHandler()
-    streamhandler.setLevel(logging.ERROR)
-    # create formatter and add it to the handlers
-    streamformatter = logging.Formatter('%(levelname)s: %(message)s')
-    streamhandler.setFormatter(streamformatter)
-    # add the handler to logger
-    logger.addHandler(streamhandler)
+    # Set up a specific logger writing to the log file and the console
+    logger = BongLogging.configure(logfile, verbosity, asynchronous)
 
 
 def initializeEnvironment(mainScript):
@@ -75,10 +84,12 @@ def initializeEnvironment(mainScript):
         print "Terminating because data directory is missing ({})".format(datadir)
         sys.exit(1)
     else:
-        # set path to cache files 
-        settings['getRecordingsCache'] = os.path.join(datadir, 'getRecordings.cache')
-        settings['checkCredentialsCache'] = os.path.join(datadir, 'checkCredentials.cache')
+        # set path to the response cache, created on first use
+        settings['cachedir'] = os.path.join(datadir, 'cache')
         
+    # state of the last run, read by the fast path
+    settings['statefile'] = os.path.join(datadir, 'LastRun.json')
+
     # configuration file ../dta/Settings.ini must exist
     settings['inifile'] = os.path.join(datadir, 'Settings.ini')
     if not os.path.isfile(settings['inifile']):
@@ -98,12 +109,16 @@ def initializeEnvironment(mainScript):
         sys.exit(1)
     else:
         settings['logfile'] = os.path.join(logdir, '{}.log'.format(scriptname))
+        settings['metricsFile'] = os.path.join(logdir, '{}.prom'.format(scriptname))
     
     # recording directoy ../rec must exist
     settings['recdir'] = os.path.normpath(os.path.join(scriptpath, '../rec'))
     if not os.path.isdir(settings['recdir']):
         print "Terminating because recordings directory is missing ({})".format(settings['recdir'])
         sys.exit(1)
+    else:
+        # images shared by recordings are hard linked from here, so it must be on the same volume
+        settings['artworkdir'] = os.path.join(settings['recdir'], '.artwork')
     
     config = ConfigParser.SafeConfigParser()
     config.read(settings['inifile'])
@@ -111,6 +126,19 @@ def initializeEnvironment(mainScript):
     settings['bong_password'] = config.get('bong.tv', 'password')
     settings['bong_server'] = config.get('bong.tv', 'server')
 
+    # the [bong.tv] section is the account named default, [bong.tv name] sections add accounts
+    settings['accounts'] = [ { 'name': 'default'
+                             , 'username': settings['bong_username']
+                             , 'password': settings['bong_password']
+                             , 'server': settings['bong_server'] } ]
+    for section in config.sections():
+        m = re.match(r"^bong\.tv\s+(\S.*)$", section)
+        if m:
+            settings['accounts'].append( { 'name': m.group(1).strip()
+                                         , 'username': config.get(section, 'username')
+                                         , 'password': config.get(section, 'password')
+                                         , 'server': config.get(section, 'server') if config.has_option(section, 'server') else settings['bong_server'] } )
+
     if config.get('options', 'verbose').strip().lower() in ('true', 't', 'yes', 'y', 1):
         settings['verbose'] = True
     else:
@@ -123,7 +151,120 @@ def initializeEnvironment(mainScript):
     else:
         settings['cacheLifeSpan'] = 0
 
-    ConfigureLogging(settings['logfile'], settings['verbose'])
+    # per-endpoint cache life in minutes from the [cache] section overrides cacheLifeInMinutes
+    settings['cacheLifeSpans'] = {}
+    if config.has_section('cache'):
+        for endpoint in config.options('cache'):
+            if endpoint != 'sizeinmegabytes':
+                settings['cacheLifeSpans'][endpoint] = _getIntOption(config, 'cache', endpoint, 0, 5) * 60
+    settings['cacheMaxBytes'] = _getIntOption(config, 'cache', 'sizeInMegabytes', 0, 5) * 2**20
+
+    # number of recordings downloaded at the same time
+    settings['downloadWorkers'] = max(1, _getIntOption(config, 'options', 'downloadWorkers', 1, 2))
+
+    # number of parallel range requests per video file, 1 disables segmented downloads
+    settings['downloadSegments'] = max(1, _getIntOption(config, 'options', 'downloadSegments', 1, 2))
+
+    # engine of single-stream downloads, and its receive and write sizes
+    settings['downloadEngine'] = 'builtin'
+    if config.has_option('options', 'downloadEngine'):
+        engine = config.get('options', 'downloadEngine').strip().lower()
+        if engine in ('builtin', 'urlgrabber'):
+            settings['downloadEngine'] = engine
+    settings['downloadChunkSize'] = max(1, _getIntOption(config, 'options', 'downloadChunkKilobytes', 64, 5)) * 2**10
+    settings['downloadWriteSize'] = max(1, _getIntOption(config, 'options', 'downloadWriteKilobytes', 1024, 6)) * 2**10
+
+    # number of threads fetching images
+    settings['artworkWorkers'] = max(1, _getIntOption(config, 'options', 'artworkWorkers', 4, 2))
+    # size limit of the artwork cache, 0 means unlimited
+    settings['artworkMaxBytes'] = _getIntOption(config, 'options', 'artworkMaximumMegabytes', 100, 6) * 2**20
+
+    # post-processing steps of downloaded recordings and the size of their process pool
+    settings['postProcessSteps'] = []
+    if config.has_option('postprocess', 'steps'):
+        settings['postProcessSteps'] = [s.strip() for s in config.get('postprocess', 'steps').split(',') if s.strip()]
+    settings['postProcessProcesses'] = _getIntOption(config, 'postprocess', 'processes', 0, 2)
+    settings['postProcessTimeout'] = max(1, _getIntOption(config, 'postprocess', 'timeoutInMinutes', 60, 4)) * 60
+
+    # handling of recordings sharing title, subtitle and episode with another one
+    settings['duplicatePolicy'] = 'off'
+    if config.has_option('duplicates', 'policy'):
+        policy = config.get('duplicates', 'policy').strip().lower()
+        if policy in ('off', 'first', 'hq', 'longer'):
+            settings['duplicatePolicy'] = policy
+    settings['duplicateAction'] = 'defer'
+    if config.has_option('duplicates', 'action'):
+        action = config.get('duplicates', 'action').strip().lower()
+        if action in ('skip', 'defer'):
+            settings['duplicateAction'] = action
+    settings['duplicateDelete'] = False
+    if config.has_option('duplicates', 'deleteSkipped'):
+        settings['duplicateDelete'] = config.get('duplicates', 'deleteSkipped').strip().lower() in ('true', 't', 'yes', 'y', '1')
+
+    # space always left free on the volume of the recordings directory
+    settings['minimumFreeBytes'] = _getIntOption(config, 'options', 'minimumFreeMegabytes', 100, 6) * 2**20
+
+    # leases on recordings shared with other download manager processes
+    settings['leaseSeconds'] = max(30, _getIntOption(config, 'options', 'leaseSeconds', 300, 5))
+    settings['databaseJournalMode'] = 'wal'
+    if config.has_option('options', 'databaseJournalMode'):
+        mode = config.get('options', 'databaseJournalMode').strip().lower()
+        if mode in ('wal', 'delete', 'truncate', 'persist'):
+            settings['databaseJournalMode'] = mode
+
+    # end runs early if the list of recordings is unchanged and nothing is left to do
+    settings['fastPath'] = True
+    if config.has_option('options', 'fastPath'):
+        settings['fastPath'] = config.get('options', 'fastPath').strip().lower() in ('true', 't', 'yes', 'y', '1')
+
+    # the legacy lock allowing only one process per host
+    settings['singleInstance'] = False
+    if config.has_option('options', 'singleInstance'):
+        settings['singleInstance'] = config.get('options', 'singleInstance').strip().lower() in ('true', 't', 'yes', 'y', '1')
+
+    # keep-alive connections to the bong.tv server
+    settings['connectionPoolSize'] = _getIntOption(config, 'options', 'connectionPoolSize', 2, 2)
+    settings['connectionIdleTimeout'] = _getIntOption(config, 'options', 'connectionIdleTimeout', 60)
+
+    # number of remote deletes sent together by the background delete queue
+    settings['deleteBatchSize'] = max(1, _getIntOption(config, 'options', 'deleteBatchSize', 10))
+    # failed attempts over all runs after which a remote delete is given up
+    settings['deleteMaximumAttempts'] = max(1, _getIntOption(config, 'options', 'deleteMaximumAttempts', 20, 3))
+
+    # polling interval in seconds when running as a daemon
+    settings['pollMinimumInterval'] = max(1, _getIntOption(config, 'options', 'pollMinimumInterval', 300, 5))
+    settings['pollMaximumInterval'] = max(1, _getIntOption(config, 'options', 'pollMaximumInterval', 3600, 5))
+
+    # verbosity tier of the log file, verbose = true in [options] selects the tier verbose
+    settings['logVerbosity'] = 'verbose' if settings['verbose'] else 'normal'
+    if config.has_option('logging', 'verbosity'):
+        verbosity = config.get('logging', 'verbosity').strip().lower()
+        if verbosity in BongLogging.VERBOSITY:
+            settings['logVerbosity'] = verbosity
+    settings['logAsynchronous'] = True
+    if config.has_option('logging', 'asynchronous'):
+        settings['logAsynchronous'] = config.get('logging', 'asynchronous').strip().lower() in ('true', 't', 'yes', 'y', '1')
+
+    ConfigureLogging(settings['logfile'], settings['logVerbosity'], settings['logAsynchronous'])
+
+    # metrics export, an empty textfile setting disables the file
+    if config.has_option('metrics', 'textfile'):
+        settings['metricsFile'] = config.get('metrics', 'textfile').strip() or None
+    settings['metricsPort'] = _getIntOption(config, 'metrics', 'port', 0, 5)
+
+    # order of downloads
+    settings['schedulePolicy'] = 'start'
+    if config.has_option('schedule', 'policy'):
+        policy = config.get('schedule', 'policy').strip().lower()
+        if policy in BongScheduler.POLICIES:
+            settings['schedulePolicy'] = policy
+        else:
+            logger.warning("unknown schedule policy {!r}, using {!r}".format(policy, settings['schedulePolicy']))
+    settings['channelWeights'] = _getWeights(config, 'channelWeights')
+    settings['genreWeights'] = _getWeights(config, 'genreWeights')
+
+    # time-of-day bandwidth profiles, read again by the governor when the file changes
+    settings['bandwidthDefault'], settings['bandwidthWindows'] = BongBandwidth.readProfiles(config)
     
 def LogScriptStart():
     sk = ( 'scriptname'
@@ -132,13 +273,50 @@ def LogScriptStart():
          , 'inifile'
          , 'logfile'
          , 'dbfile'
-         , 'getRecordingsCache'
-         , 'checkCredentialsCache'
+         , 'statefile'
+         , 'cachedir'
+         , 'artworkdir'
          , 'verbose'
+         , 'logVerbosity'
+         , 'logAsynchronous'
          , 'cacheLifeSpan'
+         , 'cacheLifeSpans'
+         , 'cacheMaxBytes'
+         , 'downloadWorkers'
+         , 'artworkWorkers'
+         , 'artworkMaxBytes'
+         , 'postProcessSteps'
+         , 'postProcessProcesses'
+         , 'postProcessTimeout'
+         , 'duplicatePolicy'
+         , 'duplicateAction'
+         , 'duplicateDelete'
+         , 'downloadSegments'
+         , 'downloadEngine'
+         , 'downloadChunkSize'
+         , 'downloadWriteSize'
+         , 'minimumFreeBytes'
+         , 'leaseSeconds'
+         , 'databaseJournalMode'
+         , 'singleInstance'
+         , 'fastPath'
+         , 'connectionPoolSize'
+         , 'connectionIdleTimeout'
+         , 'deleteBatchSize'
+         , 'deleteMaximumAttempts'
+         , 'pollMinimumInterval'
+         , 'pollMaximumInterval'
+         , 'bandwidthDefault'
+         , 'bandwidthWindows'
+         , 'metricsFile'
+         , 'metricsPort'
+         , 'schedulePolicy'
+         , 'channelWeights'
+         , 'genreWeights'
          , 'bong_username'
          , 'bong_password'
          , 'bong_server'
+         , 'accounts'
          )
 
     s = u"===== Script starting " + "="*58 + "\n\n"
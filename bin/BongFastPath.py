@@ -0,0 +1,125 @@
+"""
+Fast exit of scheduled runs which find nothing to do
+
+At the end of a complete run the validators of the list of recordings
+(ETag and Last-Modified), a digest of the recording ids bong.tv will
+list once the queued deletes are done, and whether anything was left
+to download or delete are stored per account in a small JSON file.
+The next run first asks bong.tv for the list with these validators. If
+the server answers 304, or the ids of the returned list have the stored
+digest, and nothing was left over, the run ends without checking the
+credentials, parsing XML or opening the recordings database. A changed
+list invalidates the cached recordings response, so the full run works
+on the list just seen rather than on an older cached one.
+
+The ids are picked from the raw response with a regular expression, so
+this module only depends on modules which are cheap to import.
+"""
+import os
+import re
+import json
+import hashlib
+import BongEnvironment
+import BongHttp
+import BongCache
+
+
+# the first <id> of every <recording> element is the id of the recording
+_ID_PATTERN = re.compile(r"<recording[\s>].*?<id>\s*([^<]*?)\s*</id>", re.DOTALL)
+_STATUS_PATTERN = re.compile(r"<status>\s*true\s*</status>")
+
+
+def idsDigest(ids):
+    return hashlib.sha1("\n".join(sorted(ids)).encode('utf-8')).hexdigest()
+
+
+def load():
+    """
+    return the stored state of all accounts
+    """
+    try:
+        with open(BongEnvironment.settings['statefile'], 'rb') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def record(account, etag, lastModified, ids, clean):
+    """
+    store the state of an account at the end of a complete run
+
+    ids are the recording ids expected in the next list, clean tells
+    whether nothing was left to download or delete.
+    """
+    fn = BongEnvironment.settings['statefile']
+    states = load()
+    states[account] = { 'etag': etag
+                      , 'lastModified': lastModified
+                      , 'ids': idsDigest(ids)
+                      , 'clean': clean }
+    tmpname = "{}.{!s}.tmp".format(fn, os.getpid())
+    with open(tmpname, 'wb') as f:
+        json.dump(states, f)
+    if os.name != 'posix' and os.path.isfile(fn):
+        os.remove(fn)
+    os.rename(tmpname, fn)
+
+
+def _invalidateCache(params):
+    """
+    remove the cached recordings response of an account
+    """
+    settings = BongEnvironment.settings
+    cache = BongCache.ResponseCache( settings['cachedir'], settings['cacheLifeSpans']
+                                   , settings['cacheLifeSpan'], settings['cacheMaxBytes'])
+    cache.invalidate('recordings', params)
+
+
+def _listUnchanged(account, state):
+    """
+    ask bong.tv whether the list of recordings of an account still matches the stored state
+    """
+    headers = {}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('lastModified'):
+        headers['If-Modified-Since'] = state['lastModified']
+    pool = BongHttp.ConnectionPool(account['server'], size=0)
+    params = {'username': account['username'], 'password': account['password']}
+    with pool.request("/api/recordings.xml", params, headers) as response:
+        if response.code == 304:
+            return True
+        if response.code != 200:
+            return False
+        body = response.read()
+        etag = response.getheader('ETag')
+        lastModified = response.getheader('Last-Modified')
+    if not _STATUS_PATTERN.search(body):
+        return False
+    ids = [unicode(i, 'utf-8') for i in _ID_PATTERN.findall(body)]
+    if idsDigest(ids) != state['ids']:
+        _invalidateCache(params)
+        return False
+    # same recordings, keep the new validators for the next run
+    record(account['name'], etag, lastModified, ids, True)
+    return True
+
+
+def unchanged():
+    """
+    check if no account has anything to download or delete since the last run
+    """
+    if not BongEnvironment.settings['fastPath']:
+        return False
+    states = load()
+    for account in BongEnvironment.settings['accounts']:
+        state = states.get(account['name'])
+        if not state or not state.get('clean'):
+            return False
+        try:
+            if not _listUnchanged(account, state):
+                return False
+        except Exception, e:
+            BongEnvironment.logger.info("fast path not taken ({!s})".format(e))
+            return False
+    return True
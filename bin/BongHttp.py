@@ -0,0 +1,208 @@
+"""
+Persistent HTTP/1.1 connections to the bong.tv server
+
+All API calls of a BongApi instance go to the same server. Instead of
+opening a new TCP connection for every request, idle keep-alive
+connections are kept in a small pool and reused by later requests.
+The server is given as host[:port], which uses HTTP, or as an http://
+or https:// URL. Redirects are followed like urllib2 did, each on a
+new connection to the host named in the Location header.
+
+User agent, timeout and number of attempts of all HTTP transfers of the
+download manager are defined here, and openUrl() is used for requests
+outside the pool.
+"""
+import time
+import socket
+import httplib
+import threading
+import urllib
+import urlparse
+import BongEnvironment
+import BongMetrics
+
+
+USER_AGENT = 'bong download manager/1.0'
+TIMEOUT = 30
+RETRIES = 5
+MAXIMUM_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+def _connect(scheme, host, timeout):
+    if scheme == 'https':
+        return httplib.HTTPSConnection(host, timeout=timeout)
+    if scheme == 'http':
+        return httplib.HTTPConnection(host, timeout=timeout)
+    raise httplib.InvalidURL("unsupported scheme {!s}".format(scheme))
+
+
+def openUrl(url, headers=None, timeout=TIMEOUT, redirects=MAXIMUM_REDIRECTS):
+    """
+    send a GET request for url on a new connection, following up to redirects redirects
+
+    Returns the connection and the response, which is not a redirect.
+    The caller closes both.
+    """
+    h = {'User-Agent': USER_AGENT}
+    if headers:
+        h.update(headers)
+    for redirect in xrange(redirects + 1):
+        parts = urlparse.urlsplit(url)
+        connection = _connect(parts.scheme.lower(), parts.netloc, timeout)
+        try:
+            path = parts.path or '/'
+            if parts.query:
+                path = "{}?{}".format(path, parts.query)
+            connection.request('GET', path, headers=h)
+            response = connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            raise
+        location = response.getheader('Location')
+        if response.status not in REDIRECT_CODES or not location:
+            return connection, response
+        response.close()
+        connection.close()
+        if redirect == redirects:
+            raise httplib.HTTPException("too many redirects for {!s}".format(url.split('?', 1)[0]))
+        url = urlparse.urljoin(url, location)
+        BongEnvironment.logger.info("redirected to {!s}".format(url.split('?', 1)[0]))
+
+
+class PooledResponse:
+    """
+    a response read from a pooled connection
+
+    The connection is handed back to the pool once the response has been
+    read completely and closed. Responses of redirected requests have no
+    pool, their connection is closed.
+    """
+
+    def __init__(self, pool, connection, response):
+        self._pool = pool
+        self._connection = connection
+        self._response = response
+        self.code = response.status
+        self.msg = response.reason
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._response.read()
+        return self._response.read(amt)
+
+    def close(self):
+        if self._connection is None:
+            return
+        if self._pool is None:
+            self._response.close()
+            self._connection.close()
+            self._connection = None
+            return
+        try:
+            # drain unread content so the connection can be reused
+            while self._response.read(2**16):
+                pass
+            reusable = not self._response.will_close
+        except (httplib.HTTPException, socket.error):
+            reusable = False
+        self._pool.release(self._connection, reusable)
+        self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ConnectionPool:
+    """
+    a pool of keep-alive connections to a single host
+
+    At most size idle connections are kept; connections idle for more
+    than idleTimeout seconds are closed instead of being reused.
+    """
+
+    def __init__(self, server, size=2, idleTimeout=60, timeout=TIMEOUT):
+        if "://" in server:
+            parts = urlparse.urlsplit(server)
+            self.scheme, self.host = parts.scheme.lower(), parts.netloc
+        else:
+            self.scheme, self.host = 'http', server
+        self.size = size
+        self.idleTimeout = idleTimeout
+        self.timeout = timeout
+        self.opened = 0
+        self.reused = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        return an idle connection or open a new one, and whether it is reused
+        """
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                connection, lastUsed = self._idle.pop()
+                if now - lastUsed < self.idleTimeout:
+                    self.reused += 1
+                    return connection, True
+                connection.close()
+            self.opened += 1
+        return _connect(self.scheme, self.host, self.timeout), False
+
+    def release(self, connection, reusable=True):
+        with self._lock:
+            if reusable and len(self._idle) < self.size:
+                self._idle.append((connection, time.time()))
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            for connection, lastUsed in self._idle:
+                connection.close()
+            del self._idle[:]
+
+    def request(self, path, params=None, headers=None):
+        """
+        send a GET request and return a PooledResponse
+
+        A reused connection may have been closed by the server in the
+        meantime, in this case the request is repeated once on a new
+        connection. Redirects are followed.
+        """
+        if params:
+            path = "{}?{}".format(path, urllib.urlencode(params))
+        h = {'User-Agent': USER_AGENT}
+        if headers:
+            h.update(headers)
+        while True:
+            connection, reused = self.acquire()
+            try:
+                connection.request('GET', path, headers=h)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    BongMetrics.retries.inc(operation='connection')
+                    continue
+                raise
+            response = PooledResponse(self, connection, response)
+            break
+        location = response.getheader('Location')
+        if response.code not in REDIRECT_CODES or not location:
+            return response
+        response.close()
+        url = urlparse.urljoin("{}://{}{}".format(self.scheme, self.host, path), location)
+        BongEnvironment.logger.info("redirected to {!s}".format(url.split('?', 1)[0]))
+        connection, response = openUrl(url, headers, self.timeout, MAXIMUM_REDIRECTS - 1)
+        return PooledResponse(None, connection, response)
+
+    def logStatistics(self):
+        BongEnvironment.logger.info("connections to {!s}: {!s} opened, {!s} reused".format(self.host, self.opened, self.reused))
@@ -0,0 +1,114 @@
+"""
+Full-text search index over the recordings database
+
+Title, subtitle, description, channel and genre of every recording are
+indexed in the FTS4 table recording_fts. It is an external-content
+table: it holds only the index and reads the text from the recording
+table, its docid being the id of the recording row. The index is built
+when the database is prepared. Recording rows are only ever inserted,
+with increasing ids, so refreshDatabase() keeps the index in sync by
+adding the rows it has inserted in the same transaction.
+
+Searches open the database read-only, without preparing it, so they
+neither wait for nor block a running download manager.
+
+Queries use the FTS4 syntax: words match whole tokens, word* matches a
+prefix, "two words" a phrase, and column:word restricts a word to one of
+the indexed columns. Words are combined with AND unless OR is given.
+"""
+import os.path
+import sqlite3
+import BongEnvironment
+import BongDatabase
+
+
+# indexed columns of the recording table
+COLUMNS = ( "title"
+          , "subtitle"
+          , "description"
+          , "channel"
+          , "genre"
+          )
+
+# columns of the recording table returned by search()
+RESULT_COLUMNS = ( "id"
+                 , "bong_id"
+                 , "start"
+                 , "duration"
+                 , "channel"
+                 , "genre"
+                 , "title"
+                 , "subtitle"
+                 , "download_state"
+                 )
+
+
+class IndexMissing(Exception):
+    pass
+
+
+def update(con, lastId):
+    """
+    add the recordings with ids above lastId to the index, return their number
+    """
+    if not BongDatabase.searchIndex:
+        return 0
+    cur = con.execute( "insert into recording_fts (docid, {columns}) select id, {columns} from recording where id > ?"
+                       .format(columns = ", ".join(COLUMNS))
+                     , (lastId,))
+    if 0 < cur.rowcount:
+        BongEnvironment.logger.info("{!s} recordings added to the search index".format(cur.rowcount))
+    return cur.rowcount
+
+
+def rebuild():
+    """
+    index all recordings again
+    """
+    with BongDatabase.transaction() as con:
+        if not BongDatabase.searchIndex:
+            raise IndexMissing("full-text search is not available")
+        con.execute("insert into recording_fts (recording_fts) values ('rebuild')")
+
+
+def recordingDirectory(id):
+    """
+    return the directory below rec/ a recording is downloaded to
+    """
+    return os.path.join(BongEnvironment.settings['recdir'], "bong{0:06d}".format(id))
+
+
+def search(query, limit=50, downloadedOnly=False):
+    """
+    return the recordings matching query as dictionaries, latest first
+
+    Besides RESULT_COLUMNS each dictionary has the path of the recording
+    directory, or None if the recording has not been downloaded.
+    Raises IndexMissing if the database has no search index yet, and
+    sqlite3.OperationalError for malformed queries.
+    """
+    sql = """
+          select {columns}
+          from   recording_fts f
+          join   recording r on r.id = f.docid
+          where  recording_fts match ?
+          {downloaded}
+          order by r.start desc
+          limit  ?
+          """.format( columns = ", ".join("r." + c for c in RESULT_COLUMNS)
+                    , downloaded = "and    r.download_state = 0" if downloadedOnly else "")
+    # autocommit mode, the select runs without a transaction of its own
+    con = sqlite3.connect(BongEnvironment.settings['dbfile'], timeout=10, isolation_level=None)
+    try:
+        if con.execute("select count(*) from sqlite_master where name = 'recording_fts'").fetchone()[0] == 0:
+            raise IndexMissing("the recordings database has no search index yet, run the download manager once")
+        rows = con.execute(sql, (query, limit)).fetchall()
+    finally:
+        con.close()
+    results = []
+    for row in rows:
+        recording = dict(zip(RESULT_COLUMNS, row))
+        path = recordingDirectory(recording['id'])
+        recording['path'] = path if recording['download_state'] == 0 and os.path.isdir(path) else None
+        results.append(recording)
+    return results
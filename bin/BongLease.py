@@ -0,0 +1,177 @@
+"""
+Leases on recordings in the recordings database
+
+Before a recording is downloaded, the process claims it by writing its
+owner id and an expiry time into the recording row. The update only
+succeeds if the row is not downloaded yet and not held by an unexpired
+lease of another owner, so several processes, on one host or on several
+hosts sharing the recordings database, split the available recordings
+between them. A heartbeat thread extends the leases held by the process;
+the leases of a process which died expire and are claimed again by
+another one. Lease times are seconds since the epoch, so the clocks of
+the hosts must be synchronized. Leases left by crashed processes of the
+same host are released at the start of a run without waiting for them
+to expire.
+"""
+import os
+import time
+import errno
+import socket
+import threading
+import BongEnvironment
+import BongDatabase
+
+
+HOST = socket.gethostname()
+
+# identifies the leases of this process
+OWNER = "{}:{!s}:{!s}".format(HOST, os.getpid(), int(time.time()))
+
+
+def availableCondition():
+    """
+    return an SQL condition and its parameters selecting recordings not leased by another process
+    """
+    return "(lease_owner is null or lease_owner = ? or lease_expires < ?)", (OWNER, time.time())
+
+
+def _running(pid):
+    """
+    check if a process with the given id exists on this host
+    """
+    if os.name == 'nt':
+        # os.kill() would terminate the process on Windows
+        import ctypes
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        STILL_ACTIVE = 259
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        try:
+            code = ctypes.c_ulong()
+            return not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)) or code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def releaseOrphaned():
+    """
+    release the leases of processes of this host which are no longer running
+    """
+    with BongDatabase.transaction() as con:
+        owners = [row[0] for row in con.execute( "select distinct lease_owner from recording where lease_owner like ?"
+                                               , (HOST + ":%",))]
+        orphaned = []
+        for owner in owners:
+            try:
+                pid = int(owner[len(HOST) + 1:].split(':')[0])
+            except ValueError:
+                continue
+            if owner != OWNER and not _running(pid):
+                orphaned.append(owner)
+        con.executemany( "update recording set lease_owner = null, lease_expires = null where lease_owner = ?"
+                       , [(owner,) for owner in orphaned])
+    for owner in orphaned:
+        BongEnvironment.logger.info("released the leases of {!s}, the process is no longer running".format(owner))
+
+
+class LeaseKeeper:
+    """
+    the leases held by this process and the heartbeat thread renewing them
+    """
+
+    def __init__(self):
+        self.held = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def duration(self):
+        return BongEnvironment.settings['leaseSeconds']
+
+    def claim(self, account, bong_id):
+        """
+        claim a recording of an account for this process, return False if it
+        is leased by another process or has been downloaded in the meantime
+        """
+        now = time.time()
+        with BongDatabase.transaction() as con:
+            previous = con.execute( "select lease_owner from recording where account = ? and bong_id = ?"
+                                  , (account, bong_id)).fetchone()
+            cur = con.execute( """
+                               update recording
+                               set    lease_owner = ?
+                                    , lease_expires = ?
+                               where  account = ?
+                               and    bong_id = ?
+                               and    download_state = 1
+                               and    (lease_owner is null or lease_owner = ? or lease_expires < ?)
+                               """
+                             , (OWNER, now + self.duration(), account, bong_id, OWNER, now))
+            claimed = cur.rowcount == 1
+        if not claimed:
+            return False
+        if previous and previous[0] not in (None, OWNER):
+            BongEnvironment.logger.info("reclaimed expired lease of recording {!s} from {!s}".format(bong_id, previous[0]))
+        with self._lock:
+            self.held.add((account, bong_id))
+        self._startHeartbeat()
+        return True
+
+    def release(self, account, bong_id):
+        with self._lock:
+            self.held.discard((account, bong_id))
+        with BongDatabase.transaction() as con:
+            con.execute( "update recording set lease_owner = null, lease_expires = null where account = ? and bong_id = ? and lease_owner = ?"
+                       , (account, bong_id, OWNER))
+
+    def renew(self):
+        """
+        extend all leases held by this process
+        """
+        with self._lock:
+            held = list(self.held)
+        if not held:
+            return
+        expires = time.time() + self.duration()
+        with BongDatabase.transaction() as con:
+            con.executemany( "update recording set lease_expires = ? where account = ? and bong_id = ? and lease_owner = ?"
+                           , [(expires, account, bong_id, OWNER) for account, bong_id in held])
+
+    def _startHeartbeat(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._heartbeat, name="BongLease")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _heartbeat(self):
+        while not self._stopping.wait(max(1, self.duration() / 3)):
+            try:
+                self.renew()
+            except Exception:
+                BongEnvironment.logger.exception("renewing leases failed")
+
+    def stop(self):
+        """
+        stop the heartbeat and release all leases still held
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            held = list(self.held)
+        if thread is not None:
+            self._stopping.set()
+            thread.join()
+        for account, bong_id in held:
+            self.release(account, bong_id)
+
+
+keeper = LeaseKeeper()
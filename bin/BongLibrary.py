@@ -23,6 +23,27 @@ def utf8_string(param):
             param = param.encode('utf-8')
     return param
 
+_ENTITY_PATTERN = re.compile("&#?\w+;")
+
+def _fixupEntity(m):
+    text = m.group(0)
+    if text[:2] == "&#":
+        # character reference
+        try:
+            if text[:3] == "&#x":
+                return unichr(int(text[3:-1], 16))
+            else:
+                return unichr(int(text[2:-1]))
+        except ValueError:
+            pass
+    else:
+        # named entity
+        try:
+            text = unichr(htmlentitydefs.name2codepoint[text[1:-1]])
+        except KeyError:
+            pass
+    return text # leave as is
+
 def unescape(text):
     """
     Removes HTML or XML character references and entities from a text string.
@@ -33,28 +54,33 @@ def unescape(text):
     Author: Fredrik Lundh (http://effbot.org/zone/re-sub.htm#unescape-html)
     """
     if isinstance(text, basestring):
-        def fixup(m):
-            text = m.group(0)
-            if text[:2] == "&#":
-                # character reference
-                try:
-                    if text[:3] == "&#x":
-                        return unichr(int(text[3:-1], 16))
-                    else:
-                        return unichr(int(text[2:-1]))
-                except ValueError:
-                    pass
-            else:
-                # named entity
-                try:
-                    text = unichr(htmlentitydefs.name2codepoint[text[1:-1]])
-                except KeyError:
-                    pass
-            return text # leave as is
-        return re.sub("&#?\w+;", fixup, text)
+        # text without an ampersand cannot contain references
+        if "&" not in text:
+            return text
+        return _ENTITY_PATTERN.sub(_fixupEntity, text)
     else:
         return text
 
+class TeeReader:
+    """
+    file-like wrapper copying everything read from source to sink
+    
+    Used to write a response to a cache file while it is being parsed
+    """
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+        
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.source.read()
+        else:
+            data = self.source.read(size)
+        if data:
+            self.sink.write(data)
+        return data
+
+
 def alignMultipleTextLines(text):
     """
     Remove leading whitespace from multi-line strings
@@ -135,9 +161,11 @@ def renameResource(url, basename):
     l = url.split('.')
     return basename + '.' + l[-1]
 
+_BONG_DATETIME_PATTERN = re.compile("^([0-3]?[0-9])-([0-1]?[0-9])-(2[0-9]{3}) ([0-2]?[0-9]):([0-5]?[0-9])$")
+_BONG_TIME_PATTERN = re.compile("^([0-2]?[0-9]):([0-5]?[0-9])$")
+
 def bongDateTimeToSqlite(bts, default=None):
-    pattern = re.compile("^([0-3]?[0-9])-([0-1]?[0-9])-(2[0-9]{3}) ([0-2]?[0-9]):([0-5]?[0-9])$")
-    m = pattern.match(bts)
+    m = _BONG_DATETIME_PATTERN.match(bts)
     if m:
         day = leadZero(m.group(1))
         month = leadZero(m.group(2)) 
@@ -149,8 +177,7 @@ def bongDateTimeToSqlite(bts, default=None):
         return default
 
 def bongTimeToSqlite(bts, default=None):
-    pattern = re.compile("^([0-2]?[0-9]):([0-5]?[0-9])$")
-    m = pattern.match(bts)
+    m = _BONG_TIME_PATTERN.match(bts)
     if m:
         hour = leadZero(m.group(1))
         minute = leadZero(m.group(2))
@@ -158,4 +185,80 @@ def bongTimeToSqlite(bts, default=None):
     else:
         return default
 
+# columns of the recording table filled from the list of recordings, in row order
+RECORDING_FIELDS = ( "bong_id"
+                   , "title"
+                   , "subtitle"
+                   , "description"
+                   , "genre"
+                   , "channel"
+                   , "start"
+                   , "duration"
+                   , "series_season"
+                   , "series_number"
+                   , "series_count"
+                   , "image_name"
+                   , "image"
+                   , "downloadHQ"
+                   , "downloadNQ"
+                   )
 
+def normalizeRecordings(recordings, problems=None):
+    """
+    convert a whole set of parsed recordings into database rows in one pass
+    
+    recordings maps bong ids to the dictionaries built by getRecordings().
+    Returns a list of tuples with the values of RECORDING_FIELDS. Start
+    timestamps and durations are converted to SQLite format, each distinct
+    value only once; channel and genre names share one string object per
+    distinct name. Malformed timestamps and durations become None and are
+    reported as (bong_id, field, value) tuples appended to problems.
+    """
+    starts = {}
+    durations = {}
+    names = {}
+    rows = []
+    append = rows.append
+    for id, kv in recordings.iteritems():
+        get = kv.get
+        
+        # start = '23-11-2011 20:15' --> '2011-11-23 20:15:00'
+        raw = get('start')
+        try:
+            start = starts[raw]
+        except KeyError:
+            start = starts[raw] = bongDateTimeToSqlite(raw) if isinstance(raw, basestring) else None
+        if start is None and problems is not None:
+            problems.append((id, 'start', raw))
+        
+        # duration = '1:50' --> '01:50:00'
+        raw = get('duration')
+        try:
+            duration = durations[raw]
+        except KeyError:
+            duration = durations[raw] = bongTimeToSqlite(raw) if isinstance(raw, basestring) else None
+        if duration is None and problems is not None:
+            problems.append((id, 'duration', raw))
+        
+        genre = get('genre')
+        genre = names.setdefault(genre, genre)
+        channel = get('channel')
+        channel = names.setdefault(channel, channel)
+        
+        append(( get('id', id)
+               , get('title')
+               , get('subtitle')
+               , get('description')
+               , genre
+               , channel
+               , start
+               , duration
+               , get('series_season')
+               , get('series_number')
+               , get('series_count')
+               , get('image_name')
+               , get('image')
+               , get('downloadHQ')
+               , get('downloadNQ')
+               ))
+    return rows
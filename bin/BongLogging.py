@@ -0,0 +1,172 @@
+"""
+Logging for the Bong Download Manager
+
+In asynchronous mode the calling thread only puts log records on a queue,
+and a background listener thread hands them to the rotating log file and
+the console. Messages given as LazyMessage are formatted with str.format
+only when a handler actually emits them, so records below a handler's
+level cost little more than the call itself.
+
+The verbosity tiers are quiet (warnings and errors), normal (information),
+verbose (debug messages) and dump, which in addition writes every field of
+every recording and the bodies of API responses to the log file.
+"""
+import atexit
+import logging
+import logging.handlers
+import threading
+import Queue
+
+
+DUMP = 5
+logging.addLevelName(DUMP, 'DUMP')
+
+VERBOSITY = { 'quiet'  : logging.WARNING
+            , 'normal' : logging.INFO
+            , 'verbose': logging.DEBUG
+            , 'dump'   : DUMP
+            }
+
+
+class LazyMessage(object):
+    """
+    a log message formatted with str.format when it is emitted
+
+    The arguments are kept by reference, so they must not be changed after
+    the logging call.
+    """
+
+    __slots__ = ('fmt', 'args', 'kwargs')
+
+    def __init__(self, fmt, *args, **kwargs):
+        self.fmt = fmt
+        self.args = args
+        self.kwargs = kwargs
+
+    def format(self):
+        return self.fmt.format(*self.args, **self.kwargs)
+
+    def __str__(self):
+        return self.format()
+
+
+class _LazyFilter(logging.Filter):
+    """
+    replaces a LazyMessage by its text before a handler formats the record
+    """
+
+    def filter(self, record):
+        if isinstance(record.msg, LazyMessage):
+            record.msg = record.msg.format()
+        return True
+
+
+class QueueHandler(logging.Handler):
+    """
+    puts log records on a queue to be emitted by a QueueListener
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        # tracebacks are formatted right away, they refer to frames of the calling thread
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(threading.Thread):
+    """
+    background thread passing queued records to the handlers whose level they reach
+    """
+
+    def __init__(self, queue, handlers):
+        threading.Thread.__init__(self, name="BongLogging")
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """
+        emit all queued records and wait for the thread to finish
+        """
+        self.queue.put(None)
+        self.join()
+
+
+_listener = None
+
+
+def shutdown():
+    """
+    stop the listener thread after it has written all queued records
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
+
+
+def configure(logfile, verbosity='normal', asynchronous=True):
+    """
+    set up the 'Bong' logger and return it
+
+    Messages reach the log file from the given verbosity tier upwards and
+    the console from level ERROR upwards. Calling configure() again
+    replaces the handlers set up before.
+    """
+    global _listener
+    shutdown()
+
+    logger = logging.getLogger('Bong')
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    # create rotating file handler capturing all messages of the verbosity tier
+    filehandler = logging.handlers.RotatingFileHandler(logfile, maxBytes=10000000, backupCount=3, encoding='utf-8')
+    filehandler.setLevel(VERBOSITY.get(verbosity, logging.INFO))
+    filehandler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)8s - %(message)s'))
+
+    # create console handler displaying critical messages
+    streamhandler = logging.StreamHandler()
+    streamhandler.setLevel(logging.ERROR)
+    streamhandler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+
+    handlers = [filehandler, streamhandler]
+    for handler in handlers:
+        handler.addFilter(_LazyFilter())
+
+    # records below every handler's level are dropped by the logger itself
+    logger.setLevel(min(handler.level for handler in handlers))
+
+    if asynchronous:
+        queue = Queue.Queue()
+        logger.addHandler(QueueHandler(queue))
+        _listener = QueueListener(queue, handlers)
+        _listener.start()
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+    return logger
@@ -0,0 +1,214 @@
+"""
+Metrics of the download pipeline in the Prometheus text format
+
+Modules record counters, gauges and summaries in the process-wide
+registry. At the end of a run, and after every poll in daemon mode, the
+registry is written to a text file which can be picked up by the node
+exporter's textfile collector. In daemon mode the metrics can also be
+served on a local port.
+"""
+import os
+import time
+import threading
+import contextlib
+import BaseHTTPServer
+import BongEnvironment
+
+
+def _labelText(labels):
+    if not labels:
+        return u''
+    pairs = []
+    for k, v in sorted(labels):
+        v = unicode(v).replace(u'\\', u'\\\\').replace(u'"', u'\\"')
+        pairs.append(u'{}="{}"'.format(k, v))
+    return u'{' + u','.join(pairs) + u'}'
+
+
+class Metric:
+
+    kind = 'untyped'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in sorted(self.values.items())]
+
+    def text(self):
+        lines = [u"# HELP {} {}".format(self.name, self.help), u"# TYPE {} {}".format(self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append(u"{}{} {!r}".format(name, _labelText(labels), float(value)))
+        return u"\n".join(lines) + u"\n"
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    a value which can go up and down, or be sampled from a function when exported
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help):
+        Metric.__init__(self, name, help)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def setFunction(self, function, **labels):
+        with self._lock:
+            self.functions[tuple(sorted(labels.items()))] = function
+
+    def samples(self):
+        with self._lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception:
+                pass
+        return [(self.name, labels, value) for labels, value in sorted(values.items())]
+
+
+class Summary(Metric):
+    """
+    count and sum of observed values, e.g. durations in seconds
+    """
+
+    kind = 'summary'
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            count, total = self.values.get(key, (0, 0.0))
+            self.values[key] = (count + 1, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self.values.items())
+        samples = []
+        for labels, (count, total) in items:
+            samples.append((self.name + '_count', labels, count))
+            samples.append((self.name + '_sum', labels, total))
+        return samples
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = cls(name, help)
+                self.metrics[name] = metric
+            return metric
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._get(Gauge, name, help)
+
+    def summary(self, name, help):
+        return self._get(Summary, name, help)
+
+    def text(self):
+        with self._lock:
+            metrics = [self.metrics[name] for name in sorted(self.metrics.keys())]
+        return u"".join(m.text() for m in metrics)
+
+
+registry = Registry()
+
+# metrics recorded by the download manager
+apiRequestSeconds = registry.summary('bong_api_request_seconds', 'Latency of bong.tv API requests until the response headers arrived')
+xmlParseSeconds = registry.summary('bong_xml_parse_seconds', 'Time spent parsing recordings.xml')
+refreshSeconds = registry.summary('bong_refresh_database_seconds', 'Duration of refreshDatabase()')
+transferBytes = registry.counter('bong_transfer_bytes_total', 'Bytes written by completed downloads')
+transferSeconds = registry.summary('bong_transfer_seconds', 'Duration of completed downloads')
+transferSpeed = registry.gauge('bong_transfer_last_bytes_per_second', 'Speed of the last completed download')
+transferThrottled = registry.counter('bong_transfer_throttled_seconds_total', 'Time downloads waited for the bandwidth governor')
+transferDeferred = registry.counter('bong_transfer_deferred_total', 'Downloads deferred for lack of free space')
+transferFailures = registry.counter('bong_transfer_failures_total', 'Downloads which failed')
+postProcessSeconds = registry.summary('bong_postprocess_seconds', 'Duration of post-processing steps by step and status')
+duplicates = registry.counter('bong_duplicates_total', 'Duplicate recordings by action taken')
+retries = registry.counter('bong_retries_total', 'Retried operations')
+cacheRequests = registry.counter('bong_cache_requests_total', 'Response cache lookups by result')
+sqliteSeconds = registry.summary('bong_sqlite_transaction_seconds', 'Duration of database transactions including waits for the connection')
+queueDepth = registry.gauge('bong_queue_depth', 'Number of items waiting in a queue')
+runSeconds = registry.gauge('bong_run_seconds', 'Duration of the last run by result')
+lastRun = registry.gauge('bong_last_run_timestamp_seconds', 'Time the metrics were last written')
+
+
+_writeLock = threading.Lock()
+
+def writeTextFile(filename=None):
+    """
+    write all metrics to the configured text file, replacing it atomically
+    """
+    filename = filename or BongEnvironment.settings.get('metricsFile')
+    if not filename:
+        return
+    with _writeLock:
+        lastRun.set(time.time())
+        tmpname = "{}.{!s}.tmp".format(filename, os.getpid())
+        with open(tmpname, 'w') as f:
+            f.write(registry.text().encode('utf-8'))
+        if os.name != 'posix' and os.path.isfile(filename):
+            os.remove(filename)
+        os.rename(tmpname, filename)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = registry.text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port):
+    """
+    serve the metrics on 127.0.0.1:port from a background thread
+    """
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), _MetricsHandler)
+    t = threading.Thread(target=server.serve_forever, name="BongMetrics")
+    t.daemon = True
+    t.start()
+    BongEnvironment.logger.info("serving metrics on 127.0.0.1:{!s}".format(port))
+    return server
@@ -0,0 +1,327 @@
+"""
+Post-processing of downloaded recordings on a process pool
+
+When a recording has been downloaded, the download worker only puts it on
+a queue. A dispatcher thread reads the recording from the database and
+hands every configured step to a pool of worker processes, so CPU-bound
+steps run on all cores without holding up the downloads. The status and
+duration of each step are written to the postprocess table of the
+recordings database; steps still queued when a run ended are resumed by
+the next run.
+
+Built-in steps:
+
+    sidecar     writes recording.nfo and recording.json next to the video
+    thumbnail   extracts a preview image with ffmpeg, if it is installed
+    scan        checks the box structure of MP4 containers
+
+Further steps are given as module:function. The function is called in a
+worker process with the path of the video file and a dictionary of the
+recording's columns; it may raise Skipped, other exceptions mark the step
+as failed. Its return value is stored as message.
+
+A step which has not finished timeout seconds after it was handed to
+the pool when the run ends, or whose worker process was lost, is marked
+as failed.
+"""
+import os
+import os.path
+import sys
+import json
+import time
+import signal
+import struct
+import threading
+import subprocess
+import multiprocessing
+import Queue
+import BongEnvironment
+import BongDatabase
+import BongMetrics
+
+
+# columns of the recording table passed to the steps
+COLUMNS = ( "bong_id"
+          , "title"
+          , "subtitle"
+          , "description"
+          , "genre"
+          , "channel"
+          , "start"
+          , "duration"
+          , "series_season"
+          , "series_number"
+          , "series_count"
+          , "video_digest"
+          , "video_size"
+          )
+
+
+class Skipped(Exception):
+    """
+    raised by a step which does not apply to a recording
+    """
+    pass
+
+
+def _findExecutable(name):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def _xmlText(value):
+    if value is None:
+        return u''
+    return unicode(value).replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;')
+
+
+def sidecar(video, recording):
+    """
+    write the metadata of the recording as NFO and JSON files next to the video
+    """
+    directory = os.path.dirname(video)
+    nfo = [ u'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+          , u'<episodedetails>'
+          , u'  <title>{}</title>'.format(_xmlText(recording['subtitle'] or recording['title']))
+          , u'  <showtitle>{}</showtitle>'.format(_xmlText(recording['title']))
+          , u'  <plot>{}</plot>'.format(_xmlText(recording['description']))
+          , u'  <season>{}</season>'.format(_xmlText(recording['series_season']))
+          , u'  <episode>{}</episode>'.format(_xmlText(recording['series_number']))
+          , u'  <genre>{}</genre>'.format(_xmlText(recording['genre']))
+          , u'  <studio>{}</studio>'.format(_xmlText(recording['channel']))
+          , u'  <aired>{}</aired>'.format(_xmlText((recording['start'] or u'')[:10]))
+          , u'</episodedetails>'
+          , u'' ]
+    with open(os.path.join(directory, 'recording.nfo'), 'wb') as f:
+        f.write(u'\n'.join(nfo).encode('utf-8'))
+    with open(os.path.join(directory, 'recording.json'), 'wb') as f:
+        json.dump(recording, f, indent=2, sort_keys=True)
+    return "recording.nfo, recording.json"
+
+
+def thumbnail(video, recording):
+    """
+    extract a frame one minute into the video as preview.jpg using ffmpeg
+    """
+    ffmpeg = _findExecutable('ffmpeg')
+    if ffmpeg is None:
+        raise Skipped("ffmpeg not installed")
+    target = os.path.join(os.path.dirname(video), 'preview.jpg')
+    command = [ffmpeg, '-y', '-loglevel', 'error', '-ss', '60', '-i', video, '-frames:v', '1', '-vf', 'scale=320:-1', target]
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.communicate()[0]
+    if p.returncode != 0 or not os.path.isfile(target):
+        raise Exception("ffmpeg failed ({!s}): {!s}".format(p.returncode, output.strip()))
+    return "preview.jpg"
+
+
+def scan(video, recording):
+    """
+    walk the top-level boxes of an MP4 container and check that they cover the file
+    """
+    if os.path.splitext(video)[1].lower() not in ('.mp4', '.m4v', '.mov'):
+        raise Skipped("not an MP4 container")
+    size = os.path.getsize(video)
+    boxes = []
+    position = 0
+    with open(video, 'rb') as f:
+        while position < size:
+            f.seek(position)
+            header = f.read(8)
+            if len(header) < 8:
+                raise Exception("truncated box header at {!s}".format(position))
+            length, kind = struct.unpack('>I4s', header)
+            if length == 1:
+                length = struct.unpack('>Q', f.read(8))[0]
+            elif length == 0:
+                length = size - position
+            if length < 8:
+                raise Exception("invalid box size {!s} at {!s}".format(length, position))
+            boxes.append(kind)
+            position += length
+    if position != size:
+        raise Exception("boxes end at {!s}, file size is {!s}".format(position, size))
+    if 'moov' not in boxes:
+        raise Exception("no moov box")
+    return ", ".join(boxes)
+
+
+BUILTIN_STEPS = {'sidecar': sidecar, 'thumbnail': thumbnail, 'scan': scan}
+
+
+def _resolve(step):
+    if step in BUILTIN_STEPS:
+        return BUILTIN_STEPS[step]
+    module, function = step.split(':', 1)
+    __import__(module)
+    return getattr(sys.modules[module], function)
+
+
+def _initializeWorker():
+    # the parent process handles SIGINT and stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _runStep(step, video, recording):
+    """
+    run one step in a worker process, return its status, message and duration
+    """
+    started = time.time()
+    try:
+        message = _resolve(step)(video, recording)
+        # only strings can be returned from the worker and stored
+        if message is not None and not isinstance(message, unicode):
+            message = str(message).decode('utf-8', 'replace')
+        status = 'ok'
+    except Skipped, e:
+        status, message = 'skipped', str(e)
+    except Exception, e:
+        status, message = 'failed', "{}: {!s}".format(type(e).__name__, e)
+    return status, message, time.time() - started
+
+
+class Stage:
+
+    def __init__(self, steps, processes=0, timeout=3600):
+        self.steps = steps
+        self.processes = processes or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.queue = Queue.Queue()
+        self.pool = None
+        # (bong_id, step, dispatched, AsyncResult) of every step handed to the pool
+        self._results = []
+        self._lock = threading.Lock()
+        self._dispatcher = None
+        BongMetrics.queueDepth.setFunction(self.queue.qsize, queue='postprocess')
+
+    def start(self):
+        self.pool = multiprocessing.Pool(self.processes, _initializeWorker)
+        self._dispatcher = threading.Thread(target=self._dispatch, name="BongPostProcess")
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def resume(self):
+        """
+        queue the steps left unfinished by previous runs
+        """
+        with BongDatabase.transaction() as con:
+            rows = con.execute("select bong_id, video, step from postprocess where status = 'queued' order by queued").fetchall()
+        if rows:
+            BongEnvironment.logger.info("resuming {!s} post-processing steps".format(len(rows)))
+        for bong_id, video, step in rows:
+            self.queue.put((bong_id, video, [step]))
+
+    def submit(self, bong_id, video):
+        """
+        queue the post-processing of a downloaded video, returns at once
+        """
+        self.queue.put((bong_id, video, self.steps))
+
+    def _dispatch(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self._dispatchOne(*item)
+            except Exception:
+                BongEnvironment.logger.exception("dispatching post-processing of {!s} failed".format(item[0]))
+
+    def _dispatchOne(self, bong_id, video, steps):
+        with BongDatabase.transaction() as con:
+            row = con.execute( "select {} from recording where bong_id = ?".format(", ".join(COLUMNS))
+                             , (bong_id,)).fetchone()
+            if row is None:
+                con.executemany("delete from postprocess where bong_id = ? and step = ?", [(bong_id, step) for step in steps])
+                return
+            recording = dict(zip(COLUMNS, row))
+            con.executemany( """
+                             insert or replace into postprocess (bong_id, step, status, video, queued)
+                             values (?, ?, 'queued', ?, datetime('now'))
+                             """
+                           , [(bong_id, step, video) for step in steps])
+        for step in steps:
+            result = self.pool.apply_async( _runStep, (step, video, recording)
+                                          , callback=lambda result, step=step: self._finished(bong_id, step, result))
+            with self._lock:
+                # steps completed with a result need no attention from stop()
+                self._results = [r for r in self._results if not (r[3].ready() and r[3].successful())]
+                self._results.append((bong_id, step, time.time(), result))
+
+    def _finished(self, bong_id, step, result):
+        status, message, seconds = result
+        try:
+            with BongDatabase.transaction() as con:
+                con.execute( """
+                             update postprocess
+                             set    status = ?
+                                  , message = ?
+                                  , finished = datetime('now')
+                                  , seconds = ?
+                             where  bong_id = ? and step = ?
+                             """
+                           , (status, message, seconds, bong_id, step))
+            BongMetrics.postProcessSeconds.observe(seconds, step=step, status=status)
+            log = BongEnvironment.logger.warning if status == 'failed' else BongEnvironment.logger.info
+            log(u"post-processing step {} of recording {}: {} in {:.1f} seconds ({})".format(step, bong_id, status, seconds, message))
+        except Exception:
+            # an exception would end the result handler thread of the pool
+            BongEnvironment.logger.exception("recording post-processing step {!s} of {!s} failed".format(step, bong_id))
+
+    def stop(self):
+        """
+        wait for all queued steps to finish and shut down the pool
+
+        The pool calls back only for steps which returned a result, the
+        steps it lost or which exceed the timeout are marked as failed here.
+        """
+        self.queue.put(None)
+        self._dispatcher.join()
+        lost = 0
+        with self._lock:
+            results = list(self._results)
+        for bong_id, step, dispatched, result in results:
+            result.wait(max(0, dispatched + self.timeout - time.time()))
+            if not result.ready():
+                message = "not finished after {!s} seconds".format(self.timeout)
+            elif not result.successful():
+                try:
+                    result.get(0)
+                except Exception, e:
+                    message = "{}: {!s}".format(type(e).__name__, e)
+            else:
+                continue
+            lost += 1
+            self._finished(bong_id, step, ('failed', message, time.time() - dispatched))
+        if lost:
+            # workers may still be running or stuck in the lost steps
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+
+
+_stage = None
+
+
+def stage():
+    """
+    return the running post-processing stage, or None if no steps are configured
+    """
+    global _stage
+    if _stage is None and BongEnvironment.settings['postProcessSteps']:
+        _stage = Stage( BongEnvironment.settings['postProcessSteps'], BongEnvironment.settings['postProcessProcesses']
+                      , BongEnvironment.settings['postProcessTimeout'])
+        _stage.start()
+        _stage.resume()
+    return _stage
+
+
+def stop():
+    global _stage
+    if _stage is not None:
+        _stage.stop()
+        _stage = None
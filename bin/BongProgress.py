@@ -0,0 +1,123 @@
+"""
+Persistent index of partial downloads
+
+For every transfer in progress the download_progress table of the
+recordings database records the URL, the expected length, the number
+of bytes completed, the validator (ETag or Last-Modified) the server
+reported for the resource and, for segmented downloads, the segment
+map. After a crash an interrupted transfer resumes from this record,
+and a partial file is discarded if the resource has changed since.
+Running downloads record their progress every SAVE_INTERVAL bytes.
+"""
+import BongDatabase
+
+
+# bytes written between two records of a running single-stream download
+SAVE_INTERVAL = 2**23
+
+
+class Progress:
+    """
+    the recorded state of a partial download
+
+    segments is a list of [first, last, done] entries, done being the
+    number of bytes of the range first..last already written to the file.
+    Completed segments carry their digest as a fourth element.
+    """
+
+    def __init__(self, targetfile, url, length, validator, bytesCompleted=0, segments=None):
+        self.targetfile = targetfile
+        self.url = url
+        self.length = length
+        self.validator = validator
+        self.bytesCompleted = bytesCompleted
+        self.segments = segments
+        # bytes completed when the progress was last recorded
+        self.saved = bytesCompleted
+
+    def matches(self, url, length, validator):
+        """
+        check if the partial file still belongs to the given resource
+        """
+        if self.url != url:
+            return False
+        if length is not None and self.length is not None and self.length != length:
+            return False
+        if validator is not None and self.validator is not None and self.validator != validator:
+            return False
+        return True
+
+
+def _encodeSegments(segments):
+    if segments is None:
+        return None
+    return ",".join("-".join(str(v) for v in s) for s in segments)
+
+
+def _decodeSegments(text):
+    if not text:
+        return None
+    segments = []
+    for item in text.split(','):
+        values = item.split('-')
+        segments.append([int(v) for v in values[:3]] + values[3:])
+    return segments
+
+
+def load(targetfile):
+    """
+    return the Progress recorded for a target file, or None
+    """
+    with BongDatabase.transaction() as con:
+        row = con.execute( "select url, expected_length, bytes_completed, validator, segments from download_progress where targetfile = ?"
+                         , (targetfile,)).fetchone()
+    if row is None:
+        return None
+    return Progress(targetfile, row[0], row[1], row[3], row[2], _decodeSegments(row[4]))
+
+
+def save(progress):
+    """
+    record the current state of a download
+    """
+    with BongDatabase.transaction() as con:
+        con.execute( """
+                     insert or replace
+                     into   download_progress
+                           ( targetfile
+                           , url
+                           , expected_length
+                           , bytes_completed
+                           , validator
+                           , segments
+                           , updated
+                           )
+                     values ( ?, ?, ?, ?, ?, ?, datetime('now') )
+                     """
+                   , ( progress.targetfile
+                     , progress.url
+                     , progress.length
+                     , progress.bytesCompleted
+                     , progress.validator
+                     , _encodeSegments(progress.segments)))
+    progress.saved = progress.bytesCompleted
+
+
+def advance(progress, bytesCompleted, f=None):
+    """
+    update the bytes completed of a single-stream download, recording them
+    every SAVE_INTERVAL bytes after flushing the file f
+    """
+    progress.bytesCompleted = bytesCompleted
+    if bytesCompleted - progress.saved >= SAVE_INTERVAL:
+        if f is not None:
+            f.flush()
+        save(progress)
+
+
+def remove(targetfile):
+    """
+    forget a download, either completed or discarded
+    """
+    with BongDatabase.transaction() as con:
+        con.execute("delete from download_progress where targetfile = ?", (targetfile,))
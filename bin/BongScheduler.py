@@ -0,0 +1,111 @@
+"""
+Order in which recordings are downloaded
+
+Recordings are put into a priority queue instead of being downloaded in
+dictionary order. The ordering policy is selected in the [schedule]
+section of the configuration file:
+
+    start     oldest recording first (default)
+    duration  shortest recording first
+    series    episodes of a series in season and episode order
+    size      smallest video file first, sizes taken from HEAD requests
+
+Weights from the [channelWeights] and [genreWeights] sections move
+recordings of a channel or genre ahead of all recordings with a lower
+weight; channels and genres not listed have the weight 1.
+"""
+import threading
+import Queue
+import BongEnvironment
+from BongLibrary import bongDateTimeToSqlite, bongTimeToSqlite
+
+
+POLICIES = ('start', 'duration', 'series', 'size')
+
+
+def _number(text):
+    if text and text.strip().isdigit():
+        return int(text)
+    return 0
+
+
+def _policyKey(policy, kv):
+    if policy == 'duration':
+        return (bongTimeToSqlite(kv.get('duration') or '', '99:99:99'),)
+    if policy == 'series':
+        return ( kv.get('title') or u''
+               , _number(kv.get('series_season'))
+               , _number(kv.get('series_number'))
+               , bongDateTimeToSqlite(kv.get('start') or '', '9999'))
+    if policy == 'size':
+        size = kv.get('size')
+        if size is None:
+            size = float('inf')
+        return (size,)
+    return (bongDateTimeToSqlite(kv.get('start') or '', '9999'),)
+
+
+def weight(kv):
+    """
+    combined channel and genre weight of a recording
+    """
+    channels = BongEnvironment.settings['channelWeights']
+    genres = BongEnvironment.settings['genreWeights']
+    w = channels.get((kv.get('channel') or u'').lower(), 1.0)
+    w *= genres.get((kv.get('genre') or u'').lower(), 1.0)
+    return w
+
+
+def priority(policy, kv):
+    """
+    sort key of a recording, lower keys are downloaded first
+    """
+    return (-weight(kv),) + _policyKey(policy, kv)
+
+
+def probeSizes(recordings, workers):
+    """
+    fill in the expected size of the video file of every recording using HEAD requests
+    """
+    # imported on first use, so runs with nothing to do never load the download and database modules
+    import BongSegments
+    jobs = Queue.Queue()
+    for id, kv in recordings:
+        if kv.get('downloadHQ'):
+            jobs.put(kv)
+
+    def worker():
+        while True:
+            try:
+                kv = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            info = BongSegments.probe(kv['downloadHQ'])
+            if info is not None:
+                kv['size'] = info.length
+
+    threads = []
+    for i in xrange(min(workers, jobs.qsize())):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+
+def schedule(recordings):
+    """
+    return a PriorityQueue of (priority, sequence, id, kv) entries for the given
+    (id, kv) pairs according to the configured policy
+    """
+    policy = BongEnvironment.settings['schedulePolicy']
+    recordings = list(recordings)
+    if policy == 'size':
+        probeSizes(recordings, BongEnvironment.settings['downloadWorkers'])
+
+    jobs = Queue.PriorityQueue()
+    for sequence, (id, kv) in enumerate(recordings):
+        jobs.put((priority(policy, kv), sequence, id, kv))
+    BongEnvironment.logger.info("{!s} recordings scheduled by {!s}".format(jobs.qsize(), policy))
+    return jobs
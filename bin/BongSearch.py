@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Bong.tv recordings search
+
+Searches title, subtitle, description, channel and genre of all
+recordings in the recordings database using its full-text search index
+and prints the matching recordings, latest first, with the directory
+below rec/ they have been downloaded to. The database is only read, so
+searches can run while the download manager is working. --rebuild
+indexes all recordings again, which needs write access.
+
+Examples:
+
+    python BongSearch.py tatort
+    python BongSearch.py 'channel:arte doku*' --downloaded
+    python BongSearch.py '"der letzte zeuge"' --json
+"""
+import sys
+import time
+import json
+import sqlite3
+import argparse
+import BongEnvironment
+import BongDatabase
+import BongIndex
+
+
+def main():
+    parser = argparse.ArgumentParser(description="search the recordings of the Bong.tv Download Manager")
+    parser.add_argument('query', nargs='*', help="words to search for, in FTS4 query syntax")
+    parser.add_argument('--limit', type=int, default=50, help="maximum number of recordings listed")
+    parser.add_argument('--downloaded', action='store_true', help="list downloaded recordings only")
+    parser.add_argument('--json', action='store_true', help="print the recordings as JSON")
+    parser.add_argument('--rebuild', action='store_true', help="index all recordings again before searching")
+    args = parser.parse_args()
+    if not args.query and not args.rebuild:
+        parser.error("no query given")
+
+    BongEnvironment.initializeEnvironment(__file__)
+
+    if args.rebuild:
+        try:
+            BongIndex.rebuild()
+        except BongIndex.IndexMissing, e:
+            print >> sys.stderr, e
+            sys.exit(1)
+        finally:
+            BongDatabase.close()
+        if not args.query:
+            return
+
+    started = time.time()
+    query = u" ".join(unicode(word, sys.getfilesystemencoding() or 'utf-8') for word in args.query)
+    try:
+        recordings = BongIndex.search(query, args.limit, args.downloaded)
+    except BongIndex.IndexMissing, e:
+        print >> sys.stderr, e
+        sys.exit(1)
+    except sqlite3.OperationalError, e:
+        print >> sys.stderr, "invalid query {!s} ({!s})".format(query.encode('utf-8'), e)
+        sys.exit(2)
+    seconds = time.time() - started
+
+    if args.json:
+        print json.dumps(recordings, indent=2, sort_keys=True)
+    else:
+        for r in recordings:
+            title = r['title'] or u''
+            if r['subtitle']:
+                title = u"{} - {}".format(title, r['subtitle'])
+            line = u"{}  {:<12}  {}\n{:>18}  {}".format( (r['start'] or u'')[:16], r['channel'] or u'', title
+                                                       , u'', r['path'] or u"(not downloaded)")
+            print line.encode('utf-8')
+    print >> sys.stderr, "{!s} recordings found in {:.1f} ms".format(len(recordings), seconds * 1000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+Segmented download of a single file using HTTP range requests
+
+A large video file is split into several byte ranges which are fetched
+in parallel, each range written at its offset into the same preallocated
+target file. The segment map is kept in the download progress index of
+the recordings database, so an interrupted download continues every
+segment at the byte where it stopped.
+
+Every segment is hashed while it is written. The digest of a file
+downloaded in n segments is the SHA-256 of the concatenated hex digests
+of its segments, as laid out by splitRanges(length, n), and is written
+as "sha256xN:<hex>"; a file downloaded in one piece gets its plain
+SHA-256 written as "sha256:<hex>".
+"""
+import time
+import hashlib
+import socket
+import threading
+import urllib2
+import BongEnvironment
+import BongHttp
+import BongProgress
+import BongStorage
+import BongMetrics
+
+
+CHUNK_SIZE = 2**16
+
+# HEAD attempts before resuming a download with the stored resource details
+PROBE_ATTEMPTS = 3
+
+# files smaller than this are never split into segments
+MINIMUM_SEGMENT_SIZE = 2**20
+
+# the segment map is saved after this many bytes written by a segment
+SAVE_INTERVAL = 2**23
+
+
+class HeadRequest(urllib2.Request):
+    def get_method(self):
+        return "HEAD"
+
+
+class ResourceInfo:
+    """
+    size, range support and validator of a resource as reported by a HEAD request
+    """
+
+    def __init__(self, length, ranges, validator):
+        self.length = length
+        self.ranges = ranges
+        self.validator = validator
+
+
+def probe(url, attempts=1):
+    """
+    ask the server for size, range support and validator of a resource
+
+    Returns a ResourceInfo, or None if all HEAD requests failed
+    """
+    request = HeadRequest(url, headers={'User-Agent': BongHttp.USER_AGENT})
+    for attempt in xrange(attempts):
+        try:
+            response = urllib2.urlopen(request, timeout=BongHttp.TIMEOUT)
+            break
+        except (urllib2.URLError, socket.error), e:
+            BongEnvironment.logger.info("HEAD {!s} failed ({!s}), attempt {!s}".format(url, e, attempt + 1))
+            if attempt + 1 == attempts:
+                return None
+            BongMetrics.retries.inc(operation='probe')
+            time.sleep(attempt + 1)
+    try:
+        headers = response.info()
+        length = headers.getheader('Content-Length')
+        if length is None or not length.isdigit():
+            length = None
+        else:
+            length = int(length)
+        ranges = headers.getheader('Accept-Ranges', '').strip().lower() == 'bytes'
+        validator = headers.getheader('ETag') or headers.getheader('Last-Modified')
+        return ResourceInfo(length, ranges and length is not None, validator)
+    finally:
+        response.close()
+
+
+def splitRanges(length, segments):
+    """
+    split length bytes into at most the given number of [first, last, done] segments
+    """
+    segments = max(1, min(segments, length // MINIMUM_SEGMENT_SIZE))
+    size = length // segments
+    ranges = []
+    for i in xrange(segments):
+        first = i * size
+        if i == segments - 1:
+            last = length - 1
+        else:
+            last = first + size - 1
+        ranges.append([first, last, 0])
+    return ranges
+
+
+def hashFileRange(targetfile, first, length, h):
+    """
+    feed length bytes of the target file starting at first into the hash object h
+
+    Only needed to restore the hash state of a segment resumed after a crash
+    """
+    with open(targetfile, 'rb') as f:
+        f.seek(first)
+        while 0 < length:
+            data = f.read(min(CHUNK_SIZE, length))
+            if not data:
+                break
+            h.update(data)
+            length -= len(data)
+
+
+def combineDigests(segments):
+    """
+    digest of a file from the digests of its [first, last, done, digest] segments
+    """
+    if len(segments) == 1:
+        return "sha256:" + segments[0][3]
+    h = hashlib.sha256()
+    for segment in sorted(segments):
+        h.update(segment[3])
+    return "sha256x{!s}:{}".format(len(segments), h.hexdigest())
+
+
+def _fetchSegment(url, targetfile, segment, validator, saveProgress, meter):
+    """
+    fetch the missing part of a [first, last, done] segment into the target file
+
+    done is advanced as data is written; a failed attempt is retried from
+    the last byte written. The digest of the segment is appended to it
+    when the segment is complete.
+    """
+    first, last = segment[0], segment[1]
+    h = hashlib.sha256()
+    if 0 < segment[2]:
+        hashFileRange(targetfile, first, segment[2], h)
+    for attempt in xrange(BongHttp.RETRIES):
+        position = first + segment[2]
+        if position > last:
+            segment.append(h.hexdigest())
+            return True
+        try:
+            headers = { 'User-Agent': BongHttp.USER_AGENT
+                      , 'Range': 'bytes={!s}-{!s}'.format(position, last) }
+            if validator:
+                headers['If-Range'] = validator
+            response = urllib2.urlopen(urllib2.Request(url, headers=headers), timeout=BongHttp.TIMEOUT)
+            try:
+                if response.code != 206:
+                    BongEnvironment.logger.warning("range request for {!s} answered with {!s}".format(url, response.code))
+                    return False
+                unsaved = 0
+                with open(targetfile, 'r+b') as f:
+                    f.seek(position)
+                    while position <= last:
+                        data = response.read(min(CHUNK_SIZE, last - position + 1))
+                        if not data:
+                            break
+                        meter.consume(len(data))
+                        f.write(data)
+                        h.update(data)
+                        position += len(data)
+                        unsaved += len(data)
+                        if unsaved >= SAVE_INTERVAL:
+                            f.flush()
+                            segment[2] = position - first
+                            saveProgress()
+                            unsaved = 0
+            finally:
+                response.close()
+            segment[2] = position - first
+            if position > last:
+                segment.append(h.hexdigest())
+                return True
+        except (urllib2.URLError, socket.error), e:
+            segment[2] = position - first
+            BongEnvironment.logger.info("segment {!s}-{!s} of {!s} interrupted at {!s} ({!s}), attempt {!s}".format(first, last, url, position, e, attempt + 1))
+            BongMetrics.retries.inc(operation='segment')
+            time.sleep(attempt + 1)
+    return False
+
+
+def downloadSegmented(url, targetfile, info, segments, meter, progress=None):
+    """
+    download url into targetfile using the given number of parallel range requests
+
+    Received data is accounted to the bandwidth meter of the transfer.
+    progress is the recorded state of an earlier attempt for the same
+    resource, or None to start from scratch. Returns the digest of the
+    file if all segments have been fetched, otherwise None.
+    """
+    if progress is None or progress.segments is None:
+        # preallocate the target so every segment can be written at its offset
+        with open(targetfile, 'wb') as f:
+            BongStorage.preallocate(f, info.length)
+        progress = BongProgress.Progress(targetfile, url, info.length, info.validator, 0, splitRanges(info.length, segments))
+        BongProgress.save(progress)
+
+    missing = [s for s in progress.segments if len(s) < 4]
+    BongEnvironment.logger.info("segmented download of {!s}: {!s} bytes, {!s} of {!s} segments missing".format(url, info.length, len(missing), len(progress.segments)))
+
+    lock = threading.Lock()
+    failed = []
+
+    def saveProgress():
+        with lock:
+            progress.bytesCompleted = sum(s[2] for s in progress.segments)
+            BongProgress.save(progress)
+
+    def worker(segment):
+        if not _fetchSegment(url, targetfile, segment, progress.validator, saveProgress, meter):
+            with lock:
+                failed.append(segment)
+        saveProgress()
+
+    threads = []
+    for segment in missing:
+        t = threading.Thread(target=worker, args=(segment,))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    if failed:
+        BongEnvironment.logger.warning("segmented download of {!s} incomplete, {!s} segments failed".format(url, len(failed)))
+        return None
+
+    BongProgress.remove(targetfile)
+    return combineDigests(progress.segments)
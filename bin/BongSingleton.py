@@ -7,7 +7,9 @@ is only one instance running, these functions try to acquire exclusive
 access to an operating system resource for the duration of the process.
 A second instance fails to get hold of the same resource and terminates.
 
-Ensuring exclusive execution is the first action in the main script
+Exclusive execution is a legacy mode enabled by singleInstance = true,
+since leases in the recordings database let several instances share
+the available recordings
 """
 import sys
 import socket
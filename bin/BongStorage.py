@@ -0,0 +1,152 @@
+"""
+Disk space handling for downloads into the recordings directory
+
+Before a download starts, the bytes it still needs are reserved against
+the free space of the volume holding the recordings directory, minus a
+configurable minimum that is always kept free. Downloads running at the
+same time hold their reservations until their target file has been
+preallocated, or until the transfer ends where it could not be, so two
+large downloads cannot both be admitted into space that only fits one
+of them.
+
+Targets are preallocated with fallocate() where the C library and the
+file system support it, which avoids fragmentation and makes a full disk
+fail at the start of a transfer instead of halfway through.
+"""
+import os
+import errno
+import threading
+import ctypes
+import ctypes.util
+import BongEnvironment
+
+
+FALLOC_FL_KEEP_SIZE = 1
+
+
+class InsufficientSpace(Exception):
+    """
+    raised when a download does not fit into the free space of the recordings volume
+    """
+
+    def __init__(self, path, needed, available):
+        Exception.__init__(self, "{!s} bytes needed for {!s}, {!s} bytes available".format(needed, path, available))
+        self.path = path
+        self.needed = needed
+        self.available = available
+
+
+def _loadLibc():
+    if os.name != 'posix':
+        return None
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+
+_libc = _loadLibc()
+
+
+def _libcFunction(name):
+    function = getattr(_libc, name, None) if _libc is not None else None
+    if function is not None:
+        function.restype = ctypes.c_int
+    return function
+
+# the 64 bit variants take 64 bit offsets on 32 bit systems as well
+_fallocate = _libcFunction('fallocate64')
+_posix_fallocate = _libcFunction('posix_fallocate64')
+if _fallocate is not None:
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+if _posix_fallocate is not None:
+    _posix_fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+
+def freeBytes(path):
+    """
+    return the number of bytes available to the user on the volume of path,
+    or None if it cannot be determined
+    """
+    if hasattr(os, 'statvfs'):
+        st = os.statvfs(path)
+        return st.f_bavail * st.f_frsize
+    if os.name == 'nt':
+        available = ctypes.c_ulonglong(0)
+        if ctypes.windll.kernel32.GetDiskFreeSpaceExW(ctypes.c_wchar_p(path), ctypes.byref(available), None, None):
+            return available.value
+    return None
+
+
+def preallocate(f, length, keepSize=False):
+    """
+    allocate length bytes for the open file f
+
+    With keepSize the apparent size of the file stays unchanged, so data
+    can still be appended; otherwise the file is extended to length bytes.
+    Where preallocation is not supported, the file is only extended.
+    Returns True if the space has been allocated. Raises
+    InsufficientSpace if the volume is full.
+    """
+    f.flush()
+    fd = f.fileno()
+    if keepSize:
+        if _fallocate is None:
+            error = errno.EOPNOTSUPP
+        elif _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, length) != 0:
+            error = ctypes.get_errno()
+        else:
+            error = 0
+    else:
+        # posix_fallocate returns the error number instead of setting errno
+        error = _posix_fallocate(fd, 0, length) if _posix_fallocate is not None else errno.EOPNOTSUPP
+    if error == errno.ENOSPC:
+        raise InsufficientSpace(f.name, length, freeBytes(os.path.dirname(os.path.abspath(f.name))))
+    if error and not keepSize:
+        # a sparse file, its blocks are only allocated as data is written
+        f.truncate(length)
+    return not error
+
+
+class Admission:
+    """
+    reservations of free space held by the downloads running at the same time
+    """
+
+    def __init__(self):
+        self.reserved = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, path, needed):
+        """
+        reserve needed bytes on the volume of path
+
+        Raises InsufficientSpace if the bytes do not fit next to the minimum
+        free space and the reservations of other downloads.
+        """
+        minimum = BongEnvironment.settings['minimumFreeBytes']
+        with self._lock:
+            free = freeBytes(path)
+            if free is not None:
+                available = free - minimum - self.reserved
+                if available < needed:
+                    raise InsufficientSpace(path, needed, max(0, available))
+            self.reserved += needed
+        return needed
+
+    def release(self, reserved):
+        with self._lock:
+            self.reserved -= reserved
+
+
+admission = Admission()
+
+
+def finalize(partfile, targetfile):
+    """
+    move a completely downloaded file to its final name
+    """
+    with open(partfile, 'rb+') as f:
+        os.fsync(f.fileno())
+    if os.name != 'posix' and os.path.isfile(targetfile):
+        os.remove(targetfile)
+    os.rename(partfile, targetfile)
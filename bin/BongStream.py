@@ -0,0 +1,167 @@
+"""
+Built-in streaming download engine
+
+Single-stream downloads can be done by this module instead of urlgrabber.
+The response body is received with socket.recv_into() into a buffer
+allocated once per thread and passed on through memoryview slices, so no
+string objects are created for the data. Received chunks are collected
+until the write size is reached and then written and hashed in one step.
+Chunk and write size are configurable; retries, timeout and user agent
+are the same as for urlgrabber.
+"""
+import os
+import socket
+import hashlib
+import httplib
+import threading
+import BongEnvironment
+import BongHttp
+import BongSegments
+import BongProgress
+import BongMetrics
+
+
+class StreamError(Exception):
+    pass
+
+
+class _Buffers(threading.local):
+    """
+    the receive buffer of a thread, reallocated only when the write size changes
+    """
+
+    def get(self, size):
+        buf = getattr(self, 'buf', None)
+        if buf is None or len(buf) != size:
+            self.buf = buf = bytearray(size)
+            self.view = memoryview(buf)
+        return self.view
+
+_buffers = _Buffers()
+
+
+def _open(url, position):
+    """
+    send a GET request for url from position on, following redirects
+
+    Returns the connection and the response, whose status is 200 or 206.
+    """
+    headers = {}
+    if 0 < position:
+        headers['Range'] = 'bytes={!s}-'.format(position)
+    connection, response = BongHttp.openUrl(url, headers)
+    if response.status in (200, 206):
+        return connection, response
+    response.close()
+    connection.close()
+    raise StreamError("HTTP Error {!s} - {!s}".format(response.status, response.reason))
+
+
+def _receive(response, f, h, meter, chunkSize, writeSize, progress, position):
+    """
+    copy the body of response to f and the hash h, return the number of bytes received
+
+    position is the size of f when the response starts.
+    """
+    view = _buffers.get(writeSize)
+    remaining = response.length
+    # unbuffered bodies of known length are received straight from the socket
+    sock = getattr(response.fp, '_sock', None)
+    direct = sock is not None and remaining is not None and not response.chunked
+    received = 0
+    filled = 0
+    while True:
+        size = min(chunkSize, writeSize - filled)
+        if remaining is not None:
+            size = min(size, remaining)
+        if remaining == 0:
+            n = 0
+        elif direct:
+            n = sock.recv_into(view[filled:filled + size], size)
+        else:
+            data = response.read(size)
+            n = len(data)
+            view[filled:filled + n] = data
+        if n:
+            meter.consume(n)
+            filled += n
+            received += n
+            if remaining is not None:
+                remaining -= n
+        if filled and (not n or filled == writeSize):
+            f.write(view[:filled])
+            h.update(view[:filled])
+            filled = 0
+            BongProgress.advance(progress, position + received, f)
+        if not n:
+            return received
+
+
+def _complete(targetfile, progress, h):
+    """
+    return the digest of a downloaded file, or None if its size is not the expected length
+    """
+    size = os.path.getsize(targetfile)
+    if progress.length is not None and size != progress.length:
+        BongEnvironment.logger.warning("{!s} has {!s} bytes instead of {!s}".format(targetfile, size, progress.length))
+        return None
+    return "sha256:" + h.hexdigest()
+
+
+def download(url, targetfile, progress, meter, retries=BongHttp.RETRIES):
+    """
+    download url into targetfile, hashing the data as it is written
+
+    A partial target file is continued with a range request. Returns the
+    digest of the file, or None if the download failed
+    """
+    settings = BongEnvironment.settings
+    chunkSize = settings['downloadChunkSize']
+    writeSize = max(chunkSize, settings['downloadWriteSize'])
+    h = hashlib.sha256()
+    position = 0
+    try:
+        position = os.path.getsize(targetfile)
+    except OSError:
+        pass
+    if progress.length is not None and position > progress.length:
+        os.remove(targetfile)
+        position = 0
+    if position:
+        BongSegments.hashFileRange(targetfile, 0, position, h)
+    for attempt in xrange(retries):
+        if attempt:
+            BongMetrics.retries.inc(operation='stream')
+            # an interrupted attempt has written data not counted in position
+            size = os.path.getsize(targetfile) if os.path.isfile(targetfile) else 0
+            if size != position:
+                position = size
+                h = hashlib.sha256()
+                BongSegments.hashFileRange(targetfile, 0, position, h)
+        if progress.length is not None and position == progress.length:
+            return _complete(targetfile, progress, h)
+        try:
+            connection, response = _open(url, position)
+            try:
+                if position and response.status == 200:
+                    # the server ignored the range and sends the whole resource
+                    BongEnvironment.logger.info("{!s} does not honour range requests, downloading from the start".format(url))
+                    position = 0
+                    h = hashlib.sha256()
+                    mode = 'wb'
+                else:
+                    mode = 'ab'
+                with open(targetfile, mode) as f:
+                    position += _receive(response, f, h, meter, chunkSize, writeSize, progress, position)
+            finally:
+                response.close()
+                connection.close()
+            if progress.length is None or position == progress.length:
+                return _complete(targetfile, progress, h)
+            BongEnvironment.logger.warning("download of {!s} ended after {!s} of {!s} bytes".format(url, position, progress.length))
+        except (StreamError, httplib.HTTPException, IOError, socket.error), e:
+            # like urlgrabber with retrycodes [-1,4,5,6,7,12,14], HTTP and I/O errors are retried
+            BongEnvironment.logger.warning('exception {!s} trying to download {!s} to {!s}, attempt {!s}'.format(e, url, targetfile, attempt + 1))
+        progress.bytesCompleted = position
+        BongProgress.save(progress)
+    return None